@@ -1,51 +1,335 @@
-import base64
+import asyncio
+import io
+import json
 import os
-from flask import Flask, request, render_template, jsonify
-from openai import OpenAI
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
+from PIL import Image, UnidentifiedImageError
+from flask import Flask, Request, Response, request, render_template, jsonify, stream_with_context
+from werkzeug.wsgi import ClosingIterator
+from qwen_client import MODELSCOPE_BASE_URL, pool_stats
+from rate_limit import UpstreamBusy
+from router import Backend, get_router, router_stats
+from result_cache import hash_image, make_key, result_cache
+from profiling import stage
+import metrics
+from metrics import ENCODE_LATENCY, HTTP_LATENCY, HTTP_REQUESTS, IN_FLIGHT, UPLOAD_SIZE
+from image_preprocess import (
+    IMAGE_FORMAT, IMAGE_QUALITY, MAX_PIXELS, MIN_PIXELS, image_size, prepare_image, preprocess_stats, smart_resize,
+)
+from usage import BudgetExceeded, merge_snapshots, usage_tracker
 
-app = Flask(__name__)
-
-# 确保上传文件夹存在
+# 确保上传文件夹存在（只有超过内存阈值的上传才会落盘到这里）
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-def analyze_image_with_qwen(image_path, prompt):
-    # 将图片转换为base64
-    with open(image_path, 'rb') as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+# 上传文件小于该大小时完全保存在内存中，超过后才写入唯一命名的临时文件
+SPOOL_MAX_SIZE = int(os.getenv('SPOOL_MAX_SIZE', str(16 * 1024 * 1024)))
+# 发送前按模型的 max_pixels 预先缩放，默认与 Qwen2.5-VL 处理器一致
+UPLOAD_MIN_PIXELS = int(os.getenv('UPLOAD_MIN_PIXELS', str(MIN_PIXELS)))
+UPLOAD_MAX_PIXELS = int(os.getenv('UPLOAD_MAX_PIXELS', str(MAX_PIXELS)))
+# 反向代理的地址（逗号分隔）；只有来自这些地址的请求才按代理设置的 X-Client-Id 统计用量
+TRUSTED_PROXIES = {addr.strip() for addr in os.getenv('QWEN_TRUSTED_PROXIES', '').split(',') if addr.strip()}
 
-    client = OpenAI(
-        base_url='https://api-inference.modelscope.cn/v1/',
-        api_key='xxx'  #魔搭平台的Token,https://modelscope.cn/my/myaccesstoken
-    )
+class SpooledRequest(Request):
+    # 上传文件直接写入 SpooledTemporaryFile，不再经过 file.save
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_SIZE, mode='rb+', dir=UPLOAD_FOLDER, prefix='upload-'
+        )
+
+app = Flask(__name__)
+app.request_class = SpooledRequest
+
+MODELSCOPE_API_KEY = os.getenv('MODELSCOPE_API_KEY', 'xxx')  #魔搭平台的Token,https://modelscope.cn/my/myaccesstoken
+MODELSCOPE_MODEL_ID = 'Qwen/Qwen2.5-VL-72B-Instruct'  # ModelScope Model-Id
+DEFAULT_PROMPT = '描述这幅图'
+
+# 图片描述路由：默认只有魔搭一个后端，可通过 QWEN_ROUTES 的 "describe" 配置多个后端、对冲和故障转移
+describe_router = get_router('describe', [
+    Backend('modelscope', MODELSCOPE_BASE_URL, model=MODELSCOPE_MODEL_ID, api_key=MODELSCOPE_API_KEY),
+])
+
+# 批量分析的并发上限，所有 /upload_batch 请求共享同一个线程池
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+def encode_image(image, max_pixels=UPLOAD_MAX_PIXELS):
+    # 按 smart_resize 的目标尺寸缩放后重新编码，返回带正确 MIME 类型的 data URL
+    with stage('preprocess'), ENCODE_LATENCY.time():
+        prepared = prepare_image(image, min_pixels=UPLOAD_MIN_PIXELS, max_pixels=max_pixels)
+    return prepared.data_url
+
+def build_messages(image, prompt, max_pixels=UPLOAD_MAX_PIXELS):
+    image_url = encode_image(image, max_pixels)
 
     # 如果没有提供提示词，使用默认的
     if not prompt:
-        prompt = '描述这幅图'
-
-    response = client.chat.completions.create(
-        model='Qwen/Qwen2.5-VL-72B-Instruct',  # ModelScope Model-Id
-        messages=[{
-            'role': 'user',
-            'content': [{
-                'type': 'text',
-                'text': prompt,
-            }, {
-                'type': 'image_url',
-                'image_url': {
-                    'url': f'data:image/jpeg;base64,{base64_image}'
-                },
-            }],
+        prompt = DEFAULT_PROMPT
+
+    return [{
+        'role': 'user',
+        'content': [{
+            'type': 'text',
+            'text': prompt,
+        }, {
+            'type': 'image_url',
+            'image_url': {
+                'url': image_url
+            },
         }],
-        stream=False  # 改为非流式以便获取完整响应
-    )
+    }]
 
-    return response.choices[0].message.content
+def cache_key(image, prompt, max_pixels=UPLOAD_MAX_PIXELS):
+    # 缓存键：图片内容哈希 + 提示词 + 模型；缓存关闭时返回 None
+    if not result_cache.enabled:
+        return None
+    with stage('hash'):
+        digest = hash_image(image)
+    return make_key(digest, prompt or DEFAULT_PROMPT, MODELSCOPE_MODEL_ID, {
+        'min_pixels': UPLOAD_MIN_PIXELS, 'max_pixels': max_pixels,
+        'format': IMAGE_FORMAT, 'quality': IMAGE_QUALITY,
+    })
 
-@app.route('/')
-def index():
-    return '''
+def plan_request(image, client=None):
+    # 只读文件头得到尺寸，按用量预算确定本次的 max_pixels（可能调低，预算不足时抛出 BudgetExceeded）
+    width, height = image_size(image)
+    return usage_tracker.plan('describe', width, height, UPLOAD_MIN_PIXELS, UPLOAD_MAX_PIXELS, smart_resize, client)
+
+def client_id(headers, remote_addr):
+    # 用量预算按调用方统计，默认按来源地址；X-Client-Id 可由调用方任意填写，
+    # 只采用来自可信代理（QWEN_TRUSTED_PROXIES）的请求头，否则换一个值就能绕过预算
+    if remote_addr in TRUSTED_PROXIES:
+        return headers.get('X-Client-Id') or remote_addr
+    return remote_addr
+
+def analyze_image_with_qwen(image, prompt, client=None):
+    started = time.perf_counter()
+    plan = plan_request(image, client)
+    try:
+        # 相同图片和提示词直接返回缓存结果
+        key = cache_key(image, prompt, plan.max_pixels)
+        if key is not None:
+            cached = result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        # 经路由选择后端；共享客户端复用到各后端的长连接
+        response, model = describe_router.chat_completion_with_model(
+            model=MODELSCOPE_MODEL_ID,
+            messages=build_messages(image, prompt, plan.max_pixels),
+            stream=False  # 改为非流式以便获取完整响应
+        )
+        usage_tracker.record('describe', model, response.usage, time.perf_counter() - started, plan, client)
+    finally:
+        # 命中缓存或调用失败时退还预留的 token；已经 record 的 plan 不受影响
+        usage_tracker.release(plan)
+
+    result = response.choices[0].message.content
+    # 缓存键按请求的模型计算，路由到其他模型的后端时不写入
+    if key is not None and model == MODELSCOPE_MODEL_ID:
+        result_cache.set(key, result)
+    return result
+
+def analyze_image_with_qwen_stream(image, prompt, client=None):
+    # 流式调用，返回逐段产出模型生成文本的生成器
+    # 图片在调用时立即编码，因此上传文件在请求结束被关闭后生成器仍可继续迭代
+    started = time.perf_counter()
+    plan = plan_request(image, client)
+    try:
+        key = cache_key(image, prompt, plan.max_pixels)
+        cached = result_cache.get(key) if key is not None else None
+        messages = build_messages(image, prompt, plan.max_pixels) if cached is None else None
+    except BaseException:
+        usage_tracker.release(plan)
+        raise
+    if cached is not None:
+        usage_tracker.release(plan)
+
+    def generate():
+        if cached is not None:
+            yield cached
+            return
+
+        try:
+            stream, model = describe_router.chat_completion_with_model(
+                model=MODELSCOPE_MODEL_ID,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},  # 最后一个分片带回 token 用量
+            )
+        except BaseException:
+            usage_tracker.release(plan)
+            raise
+        parts = []
+        usage = None
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+                if chunk.usage:
+                    usage = chunk.usage
+        finally:
+            # 生成器被提前关闭（浏览器断开）时关闭上游连接，不再为没人读的 token 付费
+            stream.close()
+            usage_tracker.record('describe', model, usage, time.perf_counter() - started, plan, client)
+        # 只缓存请求的模型完整生成的结果
+        if key is not None and model == MODELSCOPE_MODEL_ID:
+            result_cache.set(key, ''.join(parts))
+
+    return generate()
+
+async def analyze_image_with_qwen_async(image, prompt, client=None):
+    # 基于 AsyncOpenAI 的版本：哈希和预处理放到线程池，等待上游时不占用线程
+    started = time.perf_counter()
+    plan = await asyncio.to_thread(plan_request, image, client)
+    try:
+        key = await asyncio.to_thread(cache_key, image, prompt, plan.max_pixels)
+        if key is not None:
+            cached = result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        messages = await asyncio.to_thread(build_messages, image, prompt, plan.max_pixels)
+        response, model = await describe_router.chat_completion_with_model_async(
+            model=MODELSCOPE_MODEL_ID,
+            messages=messages,
+            stream=False
+        )
+        usage_tracker.record('describe', model, response.usage, time.perf_counter() - started, plan, client)
+    finally:
+        usage_tracker.release(plan)
+
+    result = response.choices[0].message.content
+    if key is not None and model == MODELSCOPE_MODEL_ID:
+        result_cache.set(key, result)
+    return result
+
+async def analyze_image_with_qwen_stream_async(image, prompt, client=None):
+    # 异步流式调用，返回逐段产出模型生成文本的异步生成器；任务被取消时关闭上游连接
+    # 与同步版本一样，预算、解码和编码在返回前完成，错误在开始响应之前抛出
+    started = time.perf_counter()
+    plan = await asyncio.to_thread(plan_request, image, client)
+    try:
+        key = await asyncio.to_thread(cache_key, image, prompt, plan.max_pixels)
+        cached = result_cache.get(key) if key is not None else None
+        messages = await asyncio.to_thread(build_messages, image, prompt, plan.max_pixels) if cached is None else None
+    except BaseException:
+        usage_tracker.release(plan)
+        raise
+    if cached is not None:
+        usage_tracker.release(plan)
+
+    async def generate():
+        if cached is not None:
+            yield cached
+            return
+
+        try:
+            stream, model = await describe_router.chat_completion_with_model_async(
+                model=MODELSCOPE_MODEL_ID,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+            )
+        except BaseException:
+            usage_tracker.release(plan)
+            raise
+        parts = []
+        usage = None
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+                if chunk.usage:
+                    usage = chunk.usage
+        finally:
+            await stream.close()
+            usage_tracker.record('describe', model, usage, time.perf_counter() - started, plan, client)
+        if key is not None and model == MODELSCOPE_MODEL_ID:
+            result_cache.set(key, ''.join(parts))
+
+    return generate()
+
+def sse_event(data, event=None):
+    # 按 Server-Sent Events 格式编码一条消息
+    message = f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+    if event:
+        message = f'event: {event}\n' + message
+    return message
+
+def error_status(error):
+    # 按异常类型给出 HTTP 状态码，便于负载均衡和监控区分客户端错误、上游故障和自身故障
+    if isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError)):
+        return 400
+    if isinstance(error, (openai.RateLimitError, UpstreamBusy, BudgetExceeded)):
+        # 上游限流、本地排队等待配额超时，或超出用量预算
+        return 429
+    if isinstance(error, openai.APITimeoutError):
+        return 504
+    if isinstance(error, (openai.APIConnectionError, openai.APIStatusError)):
+        return 502
+    return 500
+
+def error_response(error):
+    # 返回 dict 由框架序列化为 JSON，Flask 和 Quart（asgi_app.py）通用
+    return {'error': str(error)}, error_status(error)
+
+def upload_size(file):
+    # 上传流的字节数；读完后回到开头
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def cache_metrics():
+    stats = result_cache.stats()
+    return [
+        ('qwen_cache_hits_total', 'counter', 'Result cache hits (memory and disk)', stats['hits']),
+        ('qwen_cache_disk_hits_total', 'counter', 'Result cache hits served from SQLite', stats['disk_hits']),
+        ('qwen_cache_misses_total', 'counter', 'Result cache misses', stats['misses']),
+        ('qwen_cache_evictions_total', 'counter', 'Result cache LRU evictions', stats['evictions']),
+        ('qwen_cache_bytes', 'gauge', 'Bytes held in the in-memory result cache', stats['bytes']),
+    ]
+
+def pool_metrics():
+    totals = {'requests': 0, 'new_connections': 0, 'tls_handshakes': 0}
+    for snapshot in pool_stats().values():
+        for name in totals:
+            totals[name] += snapshot[name]
+    return [
+        ('qwen_pool_requests_total', 'counter', 'Upstream HTTP requests sent through the shared pools', totals['requests']),
+        ('qwen_pool_new_connections_total', 'counter', 'Upstream TCP connections opened', totals['new_connections']),
+        ('qwen_pool_tls_handshakes_total', 'counter', 'Upstream TLS handshakes', totals['tls_handshakes']),
+    ]
+
+def preprocess_metrics():
+    stats = preprocess_stats.snapshot()
+    return [
+        ('qwen_preprocess_images_total', 'counter', 'Images prepared for upload', stats['images']),
+        ('qwen_preprocess_bytes_saved_total', 'counter', 'Upload bytes saved by resizing', stats['bytes_saved']),
+    ]
+
+def warm_up():
+    # 多进程部署（serve.py）时每个 worker 启动后调用一次：创建到各后端的连接池，加载图片编解码器
+    describe_router.warm_up()
+    Image.init()
+    Image.new('RGB', (28, 28)).save(io.BytesIO(), format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+
+metrics.register_collector(cache_metrics)
+metrics.register_collector(pool_metrics)
+metrics.register_collector(preprocess_metrics)
+# 多进程部署时 /usage、/router_stats 汇总所有 worker
+metrics.register_section('usage', usage_tracker.snapshot)
+metrics.register_section('router_stats', router_stats)
+
+INDEX_HTML = '''
     <!doctype html>
     <html>
     <head>
@@ -143,6 +427,105 @@ def index():
             URL.revokeObjectURL(url);
         }
 
+        // 渲染单张图片的分析结果
+        function renderResult(resultDiv, name, data) {
+            resultDiv.innerHTML = '';
+            const fileNameHeader = document.createElement('h3');
+            fileNameHeader.textContent = name;
+            resultDiv.appendChild(fileNameHeader);
+
+            if (data.error) {
+                const errorDiv = document.createElement('div');
+                errorDiv.textContent = `处理 ${name} 时发生错误：${data.error}`;
+                resultDiv.appendChild(errorDiv);
+                return;
+            }
+
+            // 添加分析结果
+            const contentDiv = document.createElement('div');
+            contentDiv.innerHTML = marked.parse(data.result);
+            resultDiv.appendChild(contentDiv);
+
+            // 添加下载按钮
+            const actions = document.createElement('div');
+            actions.className = 'result-actions';
+            const downloadBtn = document.createElement('button');
+            downloadBtn.className = 'btn';
+            downloadBtn.textContent = '下载Markdown';
+            downloadBtn.onclick = () => downloadMarkdown(data.result, `${name}_分析结果.md`);
+            actions.appendChild(downloadBtn);
+            resultDiv.appendChild(actions);
+        }
+
+        // 通过 SSE 流式获取单张图片的分析结果，并增量渲染 Markdown
+        async function streamSingle(file, prompt, resultDiv) {
+            const formData = new FormData();
+            formData.append('file', file);
+            formData.append('prompt', prompt);
+            formData.append('stream', '1');
+
+            let text = '';
+            let scheduled = false;
+            const contentDiv = document.createElement('div');
+            resultDiv.innerHTML = '';
+            const fileNameHeader = document.createElement('h3');
+            fileNameHeader.textContent = file.name;
+            resultDiv.appendChild(fileNameHeader);
+            resultDiv.appendChild(contentDiv);
+
+            // 每帧最多重新渲染一次，避免 token 很密时反复解析
+            const render = () => {
+                if (scheduled) return;
+                scheduled = true;
+                requestAnimationFrame(() => {
+                    scheduled = false;
+                    contentDiv.innerHTML = marked.parse(text);
+                });
+            };
+
+            try {
+                const response = await fetch('/upload', {
+                    method: 'POST',
+                    body: formData
+                });
+                if (!response.headers.get('Content-Type').startsWith('text/event-stream')) {
+                    renderResult(resultDiv, file.name, await response.json());
+                    return;
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+                    for (const raw of events) {
+                        let event = 'message';
+                        let data = '';
+                        raw.split('\\n').forEach(line => {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) data += line.slice(6);
+                        });
+                        const payload = JSON.parse(data || '{}');
+                        if (event === 'error') {
+                            renderResult(resultDiv, file.name, payload);
+                            return;
+                        }
+                        if (event === 'done') {
+                            renderResult(resultDiv, file.name, { result: text });
+                            return;
+                        }
+                        text += payload.delta;
+                        render();
+                    }
+                }
+            } catch (error) {
+                renderResult(resultDiv, file.name, { error: String(error) });
+            }
+        }
+
         document.getElementById('uploadForm').onsubmit = async function(e) {
             e.preventDefault();
             const files = document.getElementById('imageInput').files;
@@ -153,48 +536,61 @@ def index():
             loading.style.display = 'block';
             allResults.innerHTML = '';
             
-            for (let i = 0; i < files.length; i++) {
-                const formData = new FormData();
-                formData.append('file', files[i]);
-                formData.append('prompt', prompt);
-                
-                try {
-                    const response = await fetch('/upload', {
-                        method: 'POST',
-                        body: formData
-                    });
+            // 按上传顺序预先创建结果区域，结果到达后按序号填充
+            const resultDivs = Array.from(files).map(file => {
+                const resultDiv = document.createElement('div');
+                resultDiv.className = 'result markdown-body';
+                const fileNameHeader = document.createElement('h3');
+                fileNameHeader.textContent = file.name;
+                resultDiv.appendChild(fileNameHeader);
+                const pending = document.createElement('div');
+                pending.textContent = '分析中...';
+                resultDiv.appendChild(pending);
+                allResults.appendChild(resultDiv);
+                return resultDiv;
+            });
+
+            if (files.length === 1) {
+                // 单张图片走流式接口，边生成边渲染
+                await streamSingle(files[0], prompt, resultDivs[0]);
+                loading.style.display = 'none';
+                return;
+            }
+
+            const formData = new FormData();
+            Array.from(files).forEach(file => formData.append('files', file));
+            formData.append('prompt', prompt);
+            formData.append('stream', '1');
+
+            try {
+                // 一次提交全部图片，服务端并发分析，每完成一张返回一行 JSON
+                const response = await fetch('/upload_batch', {
+                    method: 'POST',
+                    body: formData
+                });
+                if (!response.ok) {
                     const data = await response.json();
-                    
-                    const resultDiv = document.createElement('div');
-                    resultDiv.className = 'result markdown-body';
-                    
-                    // 添加文件名
-                    const fileNameHeader = document.createElement('h3');
-                    fileNameHeader.textContent = files[i].name;
-                    resultDiv.appendChild(fileNameHeader);
-                    
-                    // 添加分析结果
-                    const contentDiv = document.createElement('div');
-                    contentDiv.innerHTML = marked.parse(data.result);
-                    resultDiv.appendChild(contentDiv);
-                    
-                    // 添加下载按钮
-                    const actions = document.createElement('div');
-                    actions.className = 'result-actions';
-                    const downloadBtn = document.createElement('button');
-                    downloadBtn.className = 'btn';
-                    downloadBtn.textContent = '下载Markdown';
-                    downloadBtn.onclick = () => downloadMarkdown(data.result, `${files[i].name}_分析结果.md`);
-                    actions.appendChild(downloadBtn);
-                    resultDiv.appendChild(actions);
-                    
-                    allResults.appendChild(resultDiv);
-                } catch (error) {
-                    const errorDiv = document.createElement('div');
-                    errorDiv.className = 'result';
-                    errorDiv.textContent = `处理 ${files[i].name} 时发生错误：${error}`;
-                    allResults.appendChild(errorDiv);
+                    throw new Error(data.error || response.status);
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\\n');
+                    buffer = lines.pop();
+                    lines.filter(line => line.trim()).forEach(line => {
+                        const data = JSON.parse(line);
+                        renderResult(resultDivs[data.index], files[data.index].name, data);
+                    });
                 }
+            } catch (error) {
+                const errorDiv = document.createElement('div');
+                errorDiv.className = 'result';
+                errorDiv.textContent = `批量处理时发生错误：${error}`;
+                allResults.appendChild(errorDiv);
             }
             
             loading.style.display = 'none';
@@ -204,33 +600,167 @@ def index():
     </html>
     '''
 
+class RequestMetrics:
+    # WSGI 中间件：每个请求只记录一次完成。stream_with_context 会再次推入请求上下文，
+    # teardown_request 对流式响应会执行两次，因此在响应体迭代结束、close() 之后记录，耗时包含整个流
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        IN_FLIGHT.inc()
+        finished = []
+
+        def finish():
+            if finished:
+                return
+            finished.append(True)
+            IN_FLIGHT.dec()
+            # 路由和状态码由 after_request 写入 environ；未执行到 after_request 时按 500 计
+            endpoint = environ.get('qwen.endpoint', 'unmatched')
+            status = environ.get('qwen.status', 500)
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=environ.get('REQUEST_METHOD', ''), status=status)
+            HTTP_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(iterable, finish)
+
+app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+@app.after_request
+def record_response_status(response):
+    request.environ['qwen.endpoint'] = request.url_rule.rule if request.url_rule else 'unmatched'
+    request.environ['qwen.status'] = response.status_code
+    return response
+
+@app.route('/')
+def index():
+    return INDEX_HTML
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
-        return jsonify({'error': '没有文件被上传'})
+        return jsonify({'error': '没有文件被上传'}), 400
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({'error': '没有选择文件'})
+        return jsonify({'error': '没有选择文件'}), 400
     
-    if file:
-        # 保存上传的文件
-        filename = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filename)
-        
+    UPLOAD_SIZE.observe(upload_size(file))
+    prompt = request.form.get('prompt', '')
+    # 直接从上传流编码，不写入 uploads/ 目录
+    if request.form.get('stream', request.args.get('stream', '')) in ('1', 'true'):
+        return stream_analysis(file.stream, prompt)
+
+    try:
+        # 分析图片
+        result = analyze_image_with_qwen(file.stream, prompt, client_id(request.headers, request.remote_addr))
+        return jsonify({'result': result})
+    except Exception as e:
+        return error_response(e)
+
+def stream_analysis(image, prompt):
+    # 以 SSE 推送增量结果：默认事件为文本片段，结束时发送 done，出错时发送 error
+    try:
+        deltas = analyze_image_with_qwen_stream(image, prompt, client_id(request.headers, request.remote_addr))
+    except Exception as e:
+        return error_response(e)
+
+    def generate():
         try:
-            # 获取提示词
-            prompt = request.form.get('prompt', '')
-            # 分析图片
-            result = analyze_image_with_qwen(filename, prompt)
-            # 删除临时文件
-            os.remove(filename)
-            return jsonify({'result': result})
+            for delta in deltas:
+                yield sse_event({'delta': delta})
+            yield sse_event({}, event='done')
         except Exception as e:
-            # 确保清理临时文件
-            if os.path.exists(filename):
-                os.remove(filename)
-            return jsonify({'error': str(e)})
+            yield sse_event({'error': str(e)}, event='error')
+        finally:
+            deltas.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+def analyze_upload(image, prompt, client=None):
+    # 分析一张上传的图片，返回结果或错误信息
+    try:
+        return {'result': analyze_image_with_qwen(image, prompt, client)}
+    except Exception as e:
+        return {'error': str(e), 'status': error_status(e)}
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({'error': '没有文件被上传'}), 400
+
+    prompt = request.form.get('prompt', '')
+    stream = request.form.get('stream', request.args.get('stream', '')) in ('1', 'true')
+    for file in files:
+        UPLOAD_SIZE.observe(upload_size(file))
+
+    # 每个文件各自的上传流直接并发提交给模型
+    # 流式返回时视图会先于任务结束，上传文件随请求关闭，因此先读出字节
+    client = client_id(request.headers, request.remote_addr)
+    futures = {}
+    for index, file in enumerate(files):
+        image = file.stream.read() if stream else file.stream
+        futures[batch_executor.submit(analyze_upload, image, prompt, client)] = (index, file.filename)
+
+    if not stream:
+        # 按上传顺序返回全部结果
+        results = [None] * len(files)
+        for future, (index, name) in futures.items():
+            results[index] = {'index': index, 'filename': name, **future.result()}
+        return jsonify({'results': results})
+
+    def generate():
+        # 每完成一张就输出一行 JSON（NDJSON），前端按 index 放回原位置
+        for future in as_completed(futures):
+            index, name = futures[future]
+            yield json.dumps({'index': index, 'filename': name, **future.result()}, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/cache_stats')
+def get_cache_stats():
+    # 结果缓存的命中、未命中和淘汰计数
+    return jsonify(result_cache.stats())
+
+@app.route('/preprocess_stats')
+def get_preprocess_stats():
+    # 预处理节省的上传字节数
+    return jsonify(preprocess_stats.snapshot())
+
+@app.route('/pool_stats')
+def get_pool_stats():
+    # 连接池复用统计，用于确认长连接确实被复用
+    return jsonify(pool_stats())
+
+@app.route('/router_stats')
+def get_router_stats():
+    # 各后端的延迟估计、在途请求和熔断状态；多进程部署时按 worker 进程号分别列出
+    stats = metrics.worker_sections('router_stats')
+    if len(stats) == 1:
+        return jsonify(router_stats())
+    return jsonify({str(pid): value for pid, value in stats.items()})
+
+@app.route('/usage')
+def get_usage():
+    # 按入口、模型、调用方和 max_pixels 汇总的 token、费用和耗时，以及各调用方的预算用量；
+    # 多进程部署时为所有 worker（含已退出的）的合计，调用方用量读共用的窗口
+    snapshots = metrics.worker_sections('usage', include_exited=True).values()
+    return jsonify(merge_snapshots(snapshots, usage_tracker.config, usage_tracker.client_usage()))
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus 文本格式的请求、上游、缓存和连接池指标
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""app.py 的异步版本：路由全部为协程，运行在 ASGI 服务器下
+
+等待模型返回期间不占用线程，少量进程即可承载大量在途请求：
+
+    hypercorn asgi_app:app --workers 2 --bind 0.0.0.0:5000
+    # 或
+    uvicorn asgi_app:app --workers 2 --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+
+from quart import Quart, Response, jsonify, request
+
+from app import (
+    BATCH_CONCURRENCY,
+    INDEX_HTML,
+    analyze_image_with_qwen_async,
+    analyze_image_with_qwen_stream_async,
+    client_id,
+    error_response,
+    error_status,
+    sse_event,
+    upload_size,
+)
+import metrics
+from metrics import HTTP_LATENCY, HTTP_REQUESTS, IN_FLIGHT, UPLOAD_SIZE
+from image_preprocess import preprocess_stats
+from qwen_client import close_async_clients, pool_stats
+from result_cache import result_cache
+from router import router_stats
+from usage import usage_tracker
+
+app = Quart(__name__)
+# 批量上传可能包含多张大图；流式响应的生成时间不设上限
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', str(512 * 1024 * 1024)))
+app.config['RESPONSE_TIMEOUT'] = None
+
+# 所有批量请求共享的并发上限，与 app.py 的线程池大小一致
+batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+def wants_stream(form):
+    return form.get('stream', request.args.get('stream', '')) in ('1', 'true')
+
+class RequestMetrics:
+    # ASGI 中间件：Quart 在流式响应体发送之前就执行 teardown_request，因此在整个响应发送完、
+    # 应用返回之后才记录完成，每个请求只记录一次，耗时包含整个流
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.asgi_app(scope, receive, send)
+        started = time.perf_counter()
+        IN_FLIGHT.inc()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.asgi_app(scope, receive, send_with_status)
+        finally:
+            IN_FLIGHT.dec()
+            # 路由由 after_request 写入 scope；未执行到 after_request 时记为 unmatched
+            endpoint = scope.get('qwen.endpoint', 'unmatched')
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=scope.get('method', ''), status=status)
+            HTTP_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+
+app.asgi_app = RequestMetrics(app.asgi_app)
+
+@app.after_request
+async def record_endpoint(response):
+    request.scope['qwen.endpoint'] = request.url_rule.rule if request.url_rule else 'unmatched'
+    return response
+
+@app.route('/')
+async def index():
+    return INDEX_HTML
+
+@app.route('/upload', methods=['POST'])
+async def upload_file():
+    files = await request.files
+    if 'file' not in files:
+        return jsonify({'error': '没有文件被上传'}), 400
+
+    file = files['file']
+    if file.filename == '':
+        return jsonify({'error': '没有选择文件'}), 400
+
+    UPLOAD_SIZE.observe(upload_size(file))
+    form = await request.form
+    prompt = form.get('prompt', '')
+    if wants_stream(form):
+        # 上传文件随请求结束关闭，流式响应先读出字节；预算和解码错误在开始响应前返回对应的状态码
+        try:
+            deltas = await analyze_image_with_qwen_stream_async(
+                file.read(), prompt, client_id(request.headers, request.remote_addr),
+            )
+        except Exception as e:
+            return error_response(e)
+        return stream_analysis(deltas)
+
+    try:
+        result = await analyze_image_with_qwen_async(file.stream, prompt, client_id(request.headers, request.remote_addr))
+        return jsonify({'result': result})
+    except Exception as e:
+        return error_response(e)
+
+def stream_analysis(deltas):
+    # SSE 格式与 app.py 相同；浏览器断开时 Quart 取消生成器，上游流随之关闭
+    async def generate():
+        try:
+            async for delta in deltas:
+                yield sse_event({'delta': delta}).encode('utf-8')
+            yield sse_event({}, event='done').encode('utf-8')
+        except Exception as e:
+            yield sse_event({'error': str(e)}, event='error').encode('utf-8')
+        finally:
+            await deltas.aclose()
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+async def analyze_upload(index, filename, image, prompt, client=None):
+    async with batch_semaphore:
+        try:
+            result = {'result': await analyze_image_with_qwen_async(image, prompt, client)}
+        except Exception as e:
+            result = {'error': str(e), 'status': error_status(e)}
+    return {'index': index, 'filename': filename, **result}
+
+@app.route('/upload_batch', methods=['POST'])
+async def upload_batch():
+    files = [file for file in (await request.files).getlist('files') if file.filename]
+    if not files:
+        return jsonify({'error': '没有文件被上传'}), 400
+
+    for file in files:
+        UPLOAD_SIZE.observe(upload_size(file))
+    form = await request.form
+    prompt = form.get('prompt', '')
+    client = client_id(request.headers, request.remote_addr)
+    tasks = [
+        asyncio.create_task(analyze_upload(index, file.filename, file.read(), prompt, client))
+        for index, file in enumerate(files)
+    ]
+
+    if not wants_stream(form):
+        # 按上传顺序返回全部结果
+        return jsonify({'results': await asyncio.gather(*tasks)})
+
+    async def generate():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield (json.dumps(await next_done, ensure_ascii=False) + '\n').encode('utf-8')
+        finally:
+            # 客户端断开时取消还没完成的分析
+            for task in tasks:
+                task.cancel()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/cache_stats')
+async def get_cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/preprocess_stats')
+async def get_preprocess_stats():
+    return jsonify(preprocess_stats.snapshot())
+
+@app.route('/pool_stats')
+async def get_pool_stats():
+    return jsonify(pool_stats())
+
+@app.route('/router_stats')
+async def get_router_stats():
+    return jsonify(router_stats())
+
+@app.route('/usage')
+async def get_usage():
+    return jsonify(usage_tracker.snapshot())
+
+@app.route('/metrics')
+async def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.after_serving
+async def shutdown():
+    await close_async_clients()
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,412 @@
+"""端到端与分阶段延迟基准测试
+
+启动一个本地的 OpenAI 兼容假服务（可配置首 token 延迟和生成速度），
+用 N 个并发客户端驱动四个入口函数，输出 p50/p95/p99 延迟、吞吐量和分阶段耗时（JSON）。
+
+    python benchmark.py --concurrency 1 4 16 --requests 64 --output bench.json
+    python benchmark.py --compare bench.json      # 与上次结果比较，p95 变慢超过阈值时退出码为 1
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 假服务针对不同入口返回的内容
+GROUNDING_REPLY = (
+    '<tool_call>\n'
+    '{"name": "computer_use", "arguments": {"action": "left_click", "coordinate": [120, 80]}}\n'
+    '</tool_call>'
+)
+BBOX_REPLY = (
+    '```json\n[\n'
+    + ',\n'.join(
+        f'  {{"bbox_2d": [{10 * i}, {12 * i}, {10 * i + 40}, {12 * i + 30}], "label": "船{i + 1}"}}'
+        for i in range(8)
+    )
+    + '\n]\n```'
+)
+TEXT_REPLY = '## 图片描述\n\n这是一张用于基准测试的合成图片，包含**渐变背景**和若干色块。\n'
+
+
+class FakeOpenAIServer:
+    """最小的 /chat/completions 假实现，支持流式和非流式"""
+
+    def __init__(self, latency=0.2, token_rate=50.0, output_tokens=64, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.output_tokens = output_tokens
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server._count()
+                server._handle(self, body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+
+    def _reply_for(self, body):
+        dump = json.dumps(body['messages'], ensure_ascii=False)
+        if '<tools>' in dump or 'computer_use' in dump:
+            return GROUNDING_REPLY
+        if 'bbox_2d' in dump:
+            return BBOX_REPLY
+        return TEXT_REPLY
+
+    def _handle(self, handler, body):
+        text = self._reply_for(body)
+        time.sleep(self.latency)
+        tokens = max(1, self.output_tokens)
+        step = max(1, -(-len(text) // tokens))
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        usage = {'prompt_tokens': 1000, 'completion_tokens': tokens, 'total_tokens': 1000 + tokens}
+
+        if body.get('stream'):
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'text/event-stream')
+            handler.send_header('Transfer-Encoding', 'chunked')
+            handler.end_headers()
+            for piece in pieces:
+                chunk = {
+                    'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+                }
+                self._write_chunk(handler, f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+                time.sleep(tokens / self.token_rate / len(pieces))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                chunk = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                         'choices': [], 'usage': usage}
+                self._write_chunk(handler, f'data: {json.dumps(chunk)}\n\n')
+            self._write_chunk(handler, 'data: [DONE]\n\n')
+            handler.wfile.write(b'0\r\n\r\n')
+            return
+
+        time.sleep(tokens / self.token_rate)
+        payload = json.dumps({
+            'id': 'bench', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        }, ensure_ascii=False).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    @staticmethod
+    def _write_chunk(handler, text):
+        data = text.encode('utf-8')
+        handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        handler.wfile.flush()
+
+
+class FakeLocalEngine:
+    """代替 MLX 模型的假引擎，按相同的延迟和生成速度模拟本地推理"""
+
+    def __init__(self, latency, token_rate, output_tokens):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.output_tokens = output_tokens
+
+    def generate(self, image, prompt, max_tokens, temp):
+        tokens = min(self.output_tokens, max_tokens)
+        time.sleep(self.latency + tokens / self.token_rate)
+        return TEXT_REPLY
+
+    def generate_batch(self, images, prompts, max_tokens, temp):
+        # 批量前向：一次预填充，逐 token 解码的时间与批大小无关
+        tokens = min(self.output_tokens, max_tokens)
+        time.sleep(self.latency + tokens / self.token_rate)
+        return [TEXT_REPLY for _ in images]
+
+
+def percentile(values, q):
+    """线性插值百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def make_test_image(path, width, height):
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(image)
+    for x in range(0, width, 8):
+        draw.line([(x, 0), (x, height)], fill=(x * 255 // width, 120, 255 - x * 255 // width), width=8)
+    for i in range(12):
+        x, y = (i * 997) % (width - 200), (i * 613) % (height - 120)
+        draw.rectangle([x, y, x + 200, y + 120], fill=((i * 40) % 256, 200, (i * 90) % 256))
+    image.save(path)
+    return path
+
+
+def load_local_module():
+    spec = importlib.util.spec_from_file_location('local_qwen', os.path.join(ROOT, 'local-qwen.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_targets(args):
+    """导入各入口；缺少依赖的入口记录原因后跳过"""
+    targets, skipped = {}, {}
+    prompt = '请描述这张图片'
+    bbox_prompt = '请框出图中所有的船，以 JSON 输出 bbox_2d 和 label'
+
+    def add(name, loader):
+        if args.targets and name not in args.targets:
+            return
+        try:
+            targets[name] = loader()
+        except ImportError as e:
+            skipped[name] = f'{type(e).__name__}: {e}'
+
+    def app_target():
+        import app
+        return lambda image: app.analyze_image_with_qwen(image, prompt)
+
+    def spatial_target():
+        import spatial_understanding_boat as spatial
+
+        def call(image):
+            response = spatial.inference_with_api(image, bbox_prompt)
+            return spatial.extract_json_from_text(response)
+        return call
+
+    def grounding_target():
+        import computer_use
+        return lambda image: computer_use.perform_gui_grounding_with_api(image, '打开Pull requests', 'qwen2.5-vl-7b-instruct')
+
+    def local_target():
+        module = load_local_module()
+        engine = module.engine if args.real_local else FakeLocalEngine(
+            args.latency, args.token_rate, args.output_tokens
+        )
+        module.scheduler = module.InferenceScheduler(
+            engine,
+            max_queue=max(args.concurrency) * 2,
+            max_batch_size=args.local_batch_size,
+        )
+        return lambda image: module.process_image(image, prompt, args.output_tokens, 0.0)
+
+    add('analyze_image_with_qwen', app_target)
+    add('inference_with_api', spatial_target)
+    add('perform_gui_grounding_with_api', grounding_target)
+    add('process_image', local_target)
+    return targets, skipped
+
+
+def run_load(call, image, concurrency, total):
+    """用 concurrency 个并发客户端共发出 total 个请求"""
+    from profiling import record_stages
+
+    def one(_):
+        with record_stages() as timings:
+            start = time.perf_counter()
+            error = None
+            try:
+                call(image)
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            elapsed = time.perf_counter() - start
+        return elapsed, dict(timings), error
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    wall = time.perf_counter() - wall_start
+
+    latencies = [elapsed for elapsed, _, error in results if error is None]
+    errors = [error for _, _, error in results if error is not None]
+    stage_values = {}
+    for elapsed, timings, error in results:
+        if error is not None:
+            continue
+        for name, seconds in timings.items():
+            stage_values.setdefault(name, []).append(seconds)
+        stage_values.setdefault('other', []).append(max(elapsed - sum(timings.values()), 0.0))
+
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'wall_time': wall,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'latency': summarize(latencies),
+        'stages': {name: summarize(values) for name, values in sorted(stage_values.items())},
+    }
+
+
+def compare(current, baseline, threshold):
+    """返回 p95 延迟变慢超过 threshold（比例）的条目"""
+    regressions = []
+    for name, runs in current['targets'].items():
+        old_runs = {run['concurrency']: run for run in baseline.get('targets', {}).get(name, [])}
+        for run in runs:
+            old = old_runs.get(run['concurrency'])
+            if not old or not old['latency'] or not run['latency']:
+                continue
+            before, after = old['latency']['p95'], run['latency']['p95']
+            if before and (after - before) / before > threshold:
+                regressions.append({
+                    'target': name, 'concurrency': run['concurrency'],
+                    'p95_before': before, 'p95_after': after,
+                })
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', nargs='*', help='只测试这些入口（默认全部）')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=32, help='每个并发级别的请求数')
+    parser.add_argument('--latency', type=float, default=0.2, help='假服务的首 token 延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='假服务每秒生成的 token 数')
+    parser.add_argument('--output-tokens', type=int, default=64, help='每个回复的 token 数')
+    parser.add_argument('--image', help='测试图片，默认生成一张合成图片')
+    parser.add_argument('--image-size', default='1920x1080', help='合成图片尺寸 WxH')
+    parser.add_argument('--real-local', action='store_true', help='process_image 使用真实的 MLX 模型')
+    parser.add_argument('--local-batch-size', type=int, default=1, help='process_image 调度器的微批大小')
+    parser.add_argument('--output', help='结果 JSON 路径，默认输出到标准输出')
+    parser.add_argument('--compare', help='与之前的结果 JSON 比较')
+    parser.add_argument('--threshold', type=float, default=0.1, help='p95 变慢多少比例视为回退')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = FakeOpenAIServer(args.latency, args.token_rate, args.output_tokens).start()
+
+    # 在导入入口模块之前把接口地址指向假服务，并关闭结果缓存
+    os.environ['MODELSCOPE_BASE_URL'] = server.base_url
+    os.environ['DASHSCOPE_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ['DASHSCOPE_API_KEY'] = 'benchmark'
+    os.environ['RESULT_CACHE_MAX_BYTES'] = '0'
+    os.environ['RESULT_CACHE_DB'] = ''
+    sys.path.insert(0, ROOT)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        image = args.image and os.path.abspath(args.image)
+        if not image:
+            width, height = (int(v) for v in args.image_size.lower().split('x'))
+            image = make_test_image(os.path.join(work_dir, 'bench.png'), width, height)
+
+        targets, skipped = load_targets(args)
+        # 入口函数可能在当前目录写结果图片，放到临时目录里
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            results = {}
+            for name, call in targets.items():
+                call(image)  # 预热：建立连接、导入懒加载模块
+                results[name] = []
+                for concurrency in args.concurrency:
+                    run = run_load(call, image, concurrency, args.requests)
+                    results[name].append(run)
+                    latency = run['latency']
+                    print(
+                        f'{name:32s} c={concurrency:<3d} '
+                        f'p50={latency.get("p50", 0):.3f}s p95={latency.get("p95", 0):.3f}s '
+                        f'p99={latency.get("p99", 0):.3f}s {run["throughput_rps"]:.1f} req/s '
+                        f'errors={run["errors"]}',
+                        file=sys.stderr,
+                    )
+        finally:
+            os.chdir(cwd)
+            server.stop()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'latency': args.latency,
+            'token_rate': args.token_rate,
+            'output_tokens': args.output_tokens,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'image': args.image or args.image_size,
+            'local_batch_size': args.local_batch_size,
+            'real_local': args.real_local,
+        },
+        'targets': results,
+        'skipped': skipped,
+    }
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            report['regressions'] = compare(report, json.load(f), args.threshold)
+        for item in report['regressions']:
+            print(
+                f'回退：{item["target"]} c={item["concurrency"]} '
+                f'p95 {item["p95_before"]:.3f}s -> {item["p95_after"]:.3f}s',
+                file=sys.stderr,
+            )
+        exit_code = 1 if report['regressions'] else 0
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
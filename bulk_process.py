@@ -0,0 +1,331 @@
+"""离线批量处理目录或清单中的图片，结果逐条写入 JSONL（或 Parquet），中断后可从断点续跑
+
+输入可以是目录（递归扫描图片）或清单文件（每行一个路径的文本、带 path 列的 CSV 或带 path 字段的 JSONL）。
+输入按需读取，同时在途的任务不超过 2 × 并发数，内存占用与图片总数无关。
+已成功的图片记录在输出里，重新运行同一命令会跳过它们，只处理剩余和失败的图片。
+
+    python bulk_process.py images/ --output results.jsonl --concurrency 16
+    python bulk_process.py manifest.txt --task spatial --prompt "框出所有船" --output boats.jsonl
+    python bulk_process.py images/ --format parquet --output results_parquet/   # 需要 pyarrow
+"""
+import argparse
+import csv
+import glob
+import importlib
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+
+
+def iter_directory(root):
+    # 逐个目录遍历并排序，保证每次运行的顺序一致
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(dirpath, filename)
+
+
+def iter_manifest(path):
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            rows = (row['path'] for row in csv.DictReader(f))
+        elif path.endswith('.jsonl'):
+            rows = (json.loads(line)['path'] for line in f if line.strip())
+        else:
+            rows = (line.strip() for line in f if line.strip() and not line.startswith('#'))
+        for image_path in rows:
+            yield os.path.normpath(os.path.join(base_dir, image_path))
+
+
+def iter_inputs(source):
+    """按需产出图片的绝对路径（续跑时据此判断是否已完成，与当前工作目录无关）"""
+    if os.path.isdir(source):
+        return iter_directory(os.path.abspath(source))
+    return iter_manifest(source)
+
+
+def load_task(name, prompt):
+    """返回接收图片路径、返回模型输出文本的函数；入口模块按需导入"""
+    if name == 'describe':
+        analyze_image_with_qwen = importlib.import_module('app').analyze_image_with_qwen
+        return lambda image_path: analyze_image_with_qwen(image_path, prompt)
+    if name == 'spatial':
+        inference_with_api = importlib.import_module('spatial_understanding_boat').inference_with_api
+        return lambda image_path: inference_with_api(image_path, prompt)
+    raise ValueError(f'unknown task: {name}')
+
+
+def process(call, image_path):
+    started = time.perf_counter()
+    row = {'path': image_path, 'status': 'ok', 'result': None, 'error': None}
+    try:
+        row['result'] = call(image_path)
+    except Exception as e:
+        row.update(status='error', error=f'{type(e).__name__}: {e}')
+    row['latency'] = round(time.perf_counter() - started, 4)
+    row['finished_at'] = time.time()
+    return row
+
+
+class JsonlWriter:
+    """追加写入 JSONL；每行写完即 flush，定期 fsync，进程崩溃最多丢失最后几行"""
+
+    def __init__(self, path, fsync_every=100):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._pending = 0
+        self._truncate_partial_line(path)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _truncate_partial_line(path, chunk_size=64 * 1024):
+        """续跑前截掉写到一半的最后一行，新结果从新的一行开始，不会与残行拼在一起"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            # 从文件末尾向前找最后一个换行符
+            while position > 0:
+                start = max(0, position - chunk_size)
+                f.seek(start)
+                index = f.read(position - start).rfind(b'\n')
+                if index >= 0:
+                    position = start + index + 1
+                    break
+                position = start
+            if position < end:
+                f.truncate(position)
+
+    @staticmethod
+    def completed(path):
+        """已成功处理的图片路径；最后一行不完整（写到一半崩溃）时忽略"""
+        done = set()
+        if not os.path.exists(path):
+            return done
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if row.get('status') == 'ok':
+                    done.add(row['path'])
+        return done
+
+    def write(self, row):
+        self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class ParquetWriter:
+    """写入目录下的分片文件 part-*.parquet，每 rows_per_file 行落盘一个分片
+
+    Parquet 文件无法追加，续跑时新建分片；未满一个分片的结果在中断时丢失，续跑会重新处理。
+    """
+
+    def __init__(self, directory, rows_per_file=1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('--format parquet 需要安装 pyarrow：pip install pyarrow')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.directory = directory
+        self.rows_per_file = rows_per_file
+        self._rows = []
+        self._prefix = time.strftime('%Y%m%d-%H%M%S')
+        self._parts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def completed(directory):
+        done = set()
+        parts = sorted(glob.glob(os.path.join(directory, 'part-*.parquet')))
+        if not parts:
+            return done
+        import pyarrow.parquet
+        for part in parts:
+            table = pyarrow.parquet.read_table(part, columns=['path', 'status'])
+            for image_path, status in zip(table.column('path').to_pylist(), table.column('status').to_pylist()):
+                if status == 'ok':
+                    done.add(image_path)
+        return done
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.rows_per_file:
+            self.sync()
+
+    def sync(self):
+        if not self._rows:
+            return
+        table = self._pa.Table.from_pylist(self._rows, schema=self._pa.schema([
+            ('path', self._pa.string()), ('status', self._pa.string()), ('result', self._pa.string()),
+            ('error', self._pa.string()), ('latency', self._pa.float64()), ('finished_at', self._pa.float64()),
+        ]))
+        final = os.path.join(self.directory, f'part-{self._prefix}-{self._parts:05d}.parquet')
+        # 先写临时文件再改名，续跑时不会读到写了一半的分片
+        self._pq.write_table(table, final + '.tmp')
+        os.replace(final + '.tmp', final)
+        self._parts += 1
+        self._rows = []
+
+    def close(self):
+        self.sync()
+
+
+class Progress:
+    """定期输出进度、吞吐量和预计剩余时间"""
+
+    def __init__(self, total, skipped, interval=10.0, stream=sys.stderr):
+        self.total = total
+        self.skipped = skipped
+        self.interval = interval
+        self.stream = stream
+        self.done = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def update(self, row):
+        self.done += 1
+        if row['status'] != 'ok':
+            self.errors += 1
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = None if self.total is None else max(self.total - self.skipped - self.done, 0)
+        return {
+            'processed': self.done,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'total': self.total,
+            'elapsed': round(elapsed, 1),
+            'throughput': round(rate, 3),
+            'eta_seconds': round(remaining / rate) if remaining is not None and rate else None,
+        }
+
+    def report(self):
+        stats = self.summary()
+        finished = stats['skipped'] + stats['processed']
+        if stats['total']:
+            position = f'{finished}/{stats["total"]} ({finished / stats["total"]:.1%})'
+        else:
+            position = str(finished)
+        eta = format_duration(stats['eta_seconds']) if stats['eta_seconds'] is not None else '-'
+        print(f'[{position}] {stats["throughput"]:.2f} img/s  ETA {eta}  errors {stats["errors"]}',
+              file=self.stream, flush=True)
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{hours}h{minutes:02d}m' if hours else f'{minutes}m{seconds:02d}s'
+
+
+def count_inputs(source):
+    return sum(1 for _ in iter_inputs(source))
+
+
+def run(source, call, writer, done, concurrency=8, progress=None, should_stop=lambda: False):
+    """把尚未完成的图片送入线程池，结果按完成顺序写出；在途任务不超过 2 × concurrency"""
+    pending = set()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk') as executor:
+        def drain(return_when):
+            nonlocal pending
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                row = future.result()
+                writer.write(row)
+                if progress is not None:
+                    progress.update(row)
+
+        for image_path in iter_inputs(source):
+            if should_stop():
+                break
+            if image_path in done:
+                continue
+            if len(pending) >= concurrency * 2:
+                drain(FIRST_COMPLETED)
+            pending.add(executor.submit(process, call, image_path))
+        if pending:
+            drain(ALL_COMPLETED)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='图片目录，或清单文件（.txt / .csv / .jsonl）')
+    parser.add_argument('--task', choices=['describe', 'spatial'], default='describe',
+                        help='describe 调用 app.analyze_image_with_qwen，spatial 调用 inference_with_api')
+    parser.add_argument('--prompt', default='', help='提示词，describe 为空时使用默认提示词')
+    parser.add_argument('--output', required=True, help='JSONL 文件，或 --format parquet 时的输出目录')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--rows-per-file', type=int, default=1000, help='Parquet 每个分片的行数')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='进度输出间隔（秒）')
+    parser.add_argument('--no-count', action='store_true', help='不预先统计总数（不显示 ETA）')
+    args = parser.parse_args(argv)
+    if args.task == 'spatial' and not args.prompt:
+        parser.error('--task spatial 需要 --prompt')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    writer_class = ParquetWriter if args.format == 'parquet' else JsonlWriter
+    done = writer_class.completed(args.output)
+    total = None if args.no_count else count_inputs(args.source)
+    skipped = len(done) if total is not None else 0
+    if done:
+        print(f'续跑：跳过已完成的 {len(done)} 张图片', file=sys.stderr)
+
+    # 第一次 Ctrl-C 停止提交新任务并等待在途任务写完，第二次直接退出
+    stopping = []
+
+    def on_interrupt(signum, frame):
+        if stopping:
+            raise KeyboardInterrupt
+        stopping.append(signum)
+        print('正在停止：等待在途任务完成后退出（再按一次 Ctrl-C 强制退出）', file=sys.stderr)
+
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    call = load_task(args.task, args.prompt)
+    writer = ParquetWriter(args.output, args.rows_per_file) if args.format == 'parquet' else JsonlWriter(args.output)
+    progress = Progress(total, skipped, args.progress_interval)
+    try:
+        run(args.source, call, writer, done, args.concurrency, progress, should_stop=lambda: bool(stopping))
+    finally:
+        writer.close()
+        progress.report()
+    print(json.dumps(progress.summary(), ensure_ascii=False), file=sys.stderr)
+    return 1 if progress.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
+import math
 from PIL import Image, ImageDraw, ImageColor
 
-def draw_point(image: Image.Image, point: list, color=None):
+def draw_point(image: Image.Image, point: list, color=None, inplace=False):
     if isinstance(color, str):
         try:
             color = ImageColor.getrgb(color)
@@ -10,11 +11,26 @@ def draw_point(image: Image.Image, point: list, color=None):
     else:
         color = (255, 0, 0, 128)  
 
-    overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
-    overlay_draw = ImageDraw.Draw(overlay)
+    # Work on an RGB copy unless the caller hands over an RGB image it no longer needs
+    if not inplace or image.mode != 'RGB':
+        image = image.convert('RGB')
+
     radius = min(image.size) * 0.05
     x, y = point
 
+    # Only the marker's bounding box is composited, not a full-frame overlay
+    left = max(math.floor(x - radius), 0)
+    top = max(math.floor(y - radius), 0)
+    right = min(math.ceil(x + radius) + 1, image.width)
+    bottom = min(math.ceil(y + radius) + 1, image.height)
+    if left >= right or top >= bottom:
+        return image
+
+    region = image.crop((left, top, right, bottom)).convert('RGBA')
+    overlay = Image.new('RGBA', region.size, (255, 255, 255, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    x, y = x - left, y - top
+
     overlay_draw.ellipse(
         [(x - radius, y - radius), (x + radius, y + radius)],
         fill=color
@@ -27,19 +43,24 @@ def draw_point(image: Image.Image, point: list, color=None):
         fill=(0, 255, 0, 255)
     )
 
-    image = image.convert('RGBA')
-    combined = Image.alpha_composite(image, overlay)
-
-    return combined.convert('RGB')
+    image.paste(Image.alpha_composite(region, overlay).convert('RGB'), (left, top))
+    return image
 
 ## Use an API-based approach to inference. Apply API key here:https://bailian.console.aliyun.com/
 import os
-os.environ['DASHSCOPE_API_KEY'] = "your key" 
+os.environ.setdefault('DASHSCOPE_API_KEY', "your key")
 
 import os
+import io
 import json
-import base64
-from openai import OpenAI
+import time
+import functools
+from qwen_client import DASHSCOPE_BASE_URL
+from router import Backend, get_router
+from result_cache import hash_image, make_key, result_cache
+from image_preprocess import IMAGE_FORMAT, IMAGE_QUALITY, prepare_image, read_image_bytes
+from profiling import stage
+from usage import usage_tracker
 from PIL import Image
 from IPython.display import display
 from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import (
@@ -50,11 +71,61 @@ from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import (
 from transformers.models.qwen2_5_vl.image_processing_qwen2_5_vl import smart_resize
 from utils.agent_function_call import ComputerUse
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+# Backends for grounding calls; override with the "grounding" entry of QWEN_ROUTES
+grounding_router = get_router("grounding", [
+    Backend("dashscope", DASHSCOPE_BASE_URL, api_key_env='DASHSCOPE_API_KEY'),
+])
 
-def perform_gui_grounding_with_api(screenshot_path, user_query, model_id, min_pixels=3136, max_pixels=12845056):
+# Upper bound on distinct resolutions kept; screenshots from a fleet map to only a few
+SYSTEM_PROMPT_CACHE_SIZE = int(os.getenv('SYSTEM_PROMPT_CACHE_SIZE', '64'))
+
+@functools.lru_cache(maxsize=SYSTEM_PROMPT_CACHE_SIZE)
+def _system_prompt_texts(resized_width, resized_height):
+    # The prompt depends only on the resolution, so the pydantic/templating work runs once per size
+    computer_use = ComputerUse(
+        cfg={"display_width_px": resized_width, "display_height_px": resized_height}
+    )
+    system_message = NousFnCallPrompt.preprocess_fncall_messages(
+        messages=[
+            Message(role="system", content=[ContentItem(text="You are a helpful assistant.")]),
+        ],
+        functions=[computer_use.function],
+        lang=None,
+    )
+    return tuple(msg["text"] for msg in system_message[0].model_dump()["content"])
+
+def build_system_message(resized_width, resized_height):
+    """Return the function-calling system message for a given model input resolution.
+
+    The prompt texts are memoized per (resized_width, resized_height); each call gets a fresh
+    message dict around the cached immutable texts, so callers may modify it safely.
+    """
+    return {
+        "role": "system",
+        "content": [
+            {"type": "text", "text": text} for text in _system_prompt_texts(resized_width, resized_height)
+        ],
+    }
+
+def system_prompt_cache_stats():
+    """Hit/miss counters of the system prompt cache."""
+    info = _system_prompt_texts.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+    }
+
+def parse_action(output_text):
+    """Extract the tool call JSON from the model output."""
+    return json.loads(output_text.split('<tool_call>\n')[1].split('\n</tool_call>')[0])
+
+def perform_gui_grounding_with_api(screenshot_path, user_query, model_id, min_pixels=3136, max_pixels=12845056,
+                                   output_path='computer_use_test.png', system_message=None, verbose=True, client=None,
+                                   return_action=False):
     """
     Perform GUI grounding using Qwen model to interpret user query on a screenshot.
     
@@ -64,83 +135,110 @@ def perform_gui_grounding_with_api(screenshot_path, user_query, model_id, min_pi
         model: Preloaded Qwen model
         min_pixels: Minimum pixels for the image
         max_pixels: Maximum pixels for the image
+        output_path: Where to save the annotated image (None to skip saving)
+        system_message: Result of build_system_message for this resolution (looked up when None)
+        verbose: Print the request messages
+        client: Caller identity for per-client usage budgets
+        return_action: Also return the parsed action, so callers need not parse output_text again
         
     Returns:
-        tuple: (output_text, display_image) - Model's output text and annotated image
+        tuple: (output_text, display_image) - Model's output text and annotated image;
+        (output_text, display_image, action) when return_action is set
     """
 
-    # Open and process image
-    input_image = Image.open(screenshot_path)
-    base64_image = encode_image(screenshot_path)
-    client = OpenAI(
-        api_key=os.getenv('DASHSCOPE_API_KEY'),
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
-    resized_height, resized_width = smart_resize(
-        input_image.height,
-        input_image.width,
-        min_pixels=min_pixels,
-        max_pixels=max_pixels,
-    )
-    
-    # Initialize computer use function
-    computer_use = ComputerUse(
-        cfg={"display_width_px": resized_width, "display_height_px": resized_height}
-    )
+    started = time.perf_counter()
+    # Read the screenshot once; the bytes feed hashing, the decoded image feeds encoding and annotation
+    with stage("preprocess"):
+        image_bytes = read_image_bytes(screenshot_path)
+        # Only the header is parsed here; pixels are decoded on a cache miss or when annotating
+        input_image = Image.open(io.BytesIO(image_bytes))
+        # Usage budgets may lower max_pixels (or reject); the plan carries the resulting model input size
+        plan = usage_tracker.plan(
+            "grounding", input_image.width, input_image.height, min_pixels, max_pixels, smart_resize, client,
+        )
+        max_pixels = plan.max_pixels
+        resized_height, resized_width = plan.height, plan.width
 
-    # Build messages
-    system_message = NousFnCallPrompt.preprocess_fncall_messages(
-        messages=[
-            Message(role="system", content=[ContentItem(text="You are a helpful assistant.")]),
-        ],
-        functions=[computer_use.function],
-        lang=None,
-    )
-    system_message = system_message[0].model_dump()
-    messages=[
-        {
-            "role": "system",
-            "content": [
-                {"type": "text", "text": msg["text"]} for msg in system_message["content"]
-            ],
-        },
-        {
-            "role": "user",
-            "content": [
+    try:
+        # Reuse the cached answer for an identical screenshot, query and settings before any resizing
+        # or encoding
+        key = None
+        output_text = None
+        if result_cache.enabled:
+            with stage("hash"):
+                digest = hash_image(image_bytes)
+            key = make_key(digest, user_query, model_id, {
+                "min_pixels": min_pixels, "max_pixels": max_pixels,
+                "format": IMAGE_FORMAT, "quality": IMAGE_QUALITY,
+            })
+            output_text = result_cache.get(key)
+
+        if output_text is None:
+            with stage("preprocess"):
+                input_image.load()
+                # Downscale to the size the model will use anyway before encoding
+                prepared = prepare_image(input_image, target_size=(resized_width, resized_height), raw_bytes=image_bytes)
+
+            with stage("build_request"):
+                # Build messages
+                # A precomputed prompt describes the original resolution, not a downgraded one
+                if system_message is None or plan.downgraded:
+                    system_message = build_system_message(resized_width, resized_height)
+            messages=[
+                system_message,
                 {
-                    "type": "image_url",
-                    "min_pixels": min_pixels,
-                    "max_pixels": max_pixels,
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                },
-                {"type": "text", "text": user_query},
-            ],
-        }
-    ]
-    print(json.dumps(messages, indent=4))
-    completion = client.chat.completions.create(
-        model = model_id,
-        messages = messages,
-    )
-    
-    output_text = completion.choices[0].message.content
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "min_pixels": min_pixels,
+                            "max_pixels": max_pixels,
+                            "image_url": {"url": prepared.data_url},
+                        },
+                        {"type": "text", "text": user_query},
+                    ],
+                }
+            ]
+            if verbose:
+                print(json.dumps(messages, indent=4))
+
+            completion, model = grounding_router.chat_completion_with_model(
+                model = model_id,
+                messages = messages,
+            )
+            usage_tracker.record("grounding", model, completion.usage, time.perf_counter() - started, plan, client)
+            output_text = completion.choices[0].message.content
+            # The cache key names the requested model; skip it when a backend answered with another one
+            if key is not None and model == model_id:
+                result_cache.set(key, output_text)
+    finally:
+        # Give back the reserved tokens on a cache hit or a failed call; a no-op after record()
+        usage_tracker.release(plan)
 
     # Parse action and visualize
-    action = json.loads(output_text.split('<tool_call>\n')[1].split('\n</tool_call>')[0])
-    display_image = input_image.resize((resized_width, resized_height))
-    display_image = draw_point(input_image, action['arguments']['coordinate'], color='green')
-    
-    # Save the image
-    display_image.save('computer_use_test.png')
+    with stage("parse"):
+        action = parse_action(output_text)
+    with stage("annotate"):
+        # The model answers in resized-image coordinates; map them back onto the original
+        x, y = action['arguments']['coordinate']
+        point = (x * input_image.width / resized_width, y * input_image.height / resized_height)
+        display_image = draw_point(input_image, point, color='green', inplace=True)
+        
+        # Save the image
+        if output_path:
+            display_image.save(output_path)
     
+    if return_action:
+        return output_text, display_image, action
     return output_text, display_image
 
 # Example usage
-screenshot = "assets/computer_use/computer_use2.jpeg"
-user_query = '打开Pull requests'
-model_id = "qwen2.5-vl-7b-instruct"
-output_text, display_image = perform_gui_grounding_with_api(screenshot, user_query, model_id)
-
-# Display results
-print(output_text)
-display(display_image)
\ No newline at end of file
+if __name__ == "__main__":
+    screenshot = "assets/computer_use/computer_use2.jpeg"
+    user_query = '打开Pull requests'
+    model_id = "qwen2.5-vl-7b-instruct"
+    output_text, display_image = perform_gui_grounding_with_api(screenshot, user_query, model_id)
+
+    # Display results
+    print(output_text)
+    display(display_image)
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""Batch GUI grounding over many (screenshot, query) pairs.
+
+The manifest is JSONL ({"screenshot": ..., "query": ..., "id": optional}) or CSV with the same
+columns. Requests run concurrently under a rate limit, each annotated screenshot is saved to its
+own path, and every item becomes one row of the results table (JSONL or CSV, by extension).
+
+    python computer_use_batch.py tasks.jsonl --output-dir grounding_out --concurrency 8 --rate 5
+    python computer_use_batch.py tasks.csv --results results.csv --no-images
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image
+from transformers.models.qwen2_5_vl.image_processing_qwen2_5_vl import smart_resize
+
+from computer_use import build_system_message, perform_gui_grounding_with_api, system_prompt_cache_stats
+from profiling import record_stages
+from rate_limit import TokenBucket
+
+RESULT_FIELDS = ['index', 'id', 'screenshot', 'query', 'status', 'coordinate', 'action',
+                 'output_path', 'latency', 'stages', 'error']
+
+
+def load_tasks(path):
+    """Read the manifest into a list of {'screenshot', 'query', 'id'} dicts."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    base_dir = os.path.dirname(os.path.abspath(path))
+    tasks = []
+    for index, row in enumerate(rows):
+        screenshot = row['screenshot']
+        if not os.path.isabs(screenshot):
+            # Relative paths are resolved against the manifest location
+            screenshot = os.path.join(base_dir, screenshot)
+        tasks.append({'screenshot': screenshot, 'query': row['query'], 'id': row.get('id') or str(index)})
+    return tasks
+
+
+def resolution_bucket(screenshot_path, min_pixels, max_pixels):
+    """Model input resolution (width, height); only the image header is read."""
+    with Image.open(screenshot_path) as image:
+        width, height = image.size
+    resized_height, resized_width = smart_resize(height, width, min_pixels=min_pixels, max_pixels=max_pixels)
+    return resized_width, resized_height
+
+
+def output_path_for(output_dir, index, task):
+    stem = os.path.splitext(os.path.basename(task['screenshot']))[0]
+    return os.path.join(output_dir, f"{index:06d}_{stem}.png")
+
+
+def run_one(index, task, model_id, system_message, output_path, limiter, min_pixels, max_pixels):
+    row = {'index': index, 'id': task['id'], 'screenshot': task['screenshot'], 'query': task['query'],
+           'status': 'ok', 'coordinate': None, 'action': None, 'output_path': output_path, 'error': None}
+    limiter.wait()
+    start = time.perf_counter()
+    with record_stages() as stages:
+        try:
+            # The action parsed while annotating comes back with the result; no second parse
+            _, _, action = perform_gui_grounding_with_api(
+                task['screenshot'], task['query'], model_id,
+                min_pixels=min_pixels, max_pixels=max_pixels,
+                output_path=output_path, system_message=system_message, verbose=False, return_action=True,
+            )
+            row['action'] = action
+            row['coordinate'] = action.get('arguments', {}).get('coordinate')
+        except Exception as e:
+            row.update(status='error', error=f"{type(e).__name__}: {e}", output_path=None)
+    row['latency'] = round(time.perf_counter() - start, 4)
+    row['stages'] = {name: round(seconds, 4) for name, seconds in stages.items()}
+    return row
+
+
+class ResultWriter:
+    """Appends result rows as they complete, so a partial run still leaves a usable table."""
+
+    def __init__(self, path):
+        self.path = path
+        self._csv = path.endswith('.csv')
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        if self._csv:
+            self._writer = csv.DictWriter(self._file, fieldnames=RESULT_FIELDS)
+            self._writer.writeheader()
+
+    def write(self, row):
+        if self._csv:
+            self._writer.writerow({
+                key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                for key, value in row.items()
+            })
+        else:
+            self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_batch(tasks, model_id, results_path, output_dir=None, concurrency=8, rate=None,
+              min_pixels=3136, max_pixels=12845056):
+    """Ground every task; returns a summary dict. output_dir=None skips saving images."""
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Build the system prompt per item up front (memoized per resolution bucket in computer_use)
+    system_messages = {}
+    buckets = set()
+    for index, task in enumerate(tasks):
+        try:
+            bucket = resolution_bucket(task['screenshot'], min_pixels, max_pixels)
+        except Exception:
+            # Unreadable screenshots fail inside run_one and are reported there
+            continue
+        buckets.add(bucket)
+        system_messages[index] = build_system_message(*bucket)
+
+    # Per-run start rate on top of the shared upstream limiter in qwen_client
+    limiter = TokenBucket(rate)
+    writer = ResultWriter(results_path)
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(
+                    run_one, index, task, model_id,
+                    system_messages.get(index),
+                    output_path_for(output_dir, index, task) if output_dir else None,
+                    limiter, min_pixels, max_pixels,
+                )
+                for index, task in enumerate(tasks)
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                row = future.result()
+                writer.write(row)
+                if row['status'] == 'ok':
+                    latencies.append(row['latency'])
+                else:
+                    errors += 1
+                print(f"[{done}/{len(tasks)}] {row['id']} {row['status']} {row['latency']:.2f}s"
+                      + (f" {row['error']}" if row['error'] else ''))
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    return {
+        'items': len(tasks),
+        'ok': len(latencies),
+        'errors': errors,
+        'resolution_buckets': len(buckets),
+        'system_prompt_cache': system_prompt_cache_stats(),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(tasks) / elapsed, 3) if elapsed else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'results': results_path,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='JSONL or CSV with screenshot and query columns')
+    parser.add_argument('--model-id', default='qwen2.5-vl-7b-instruct')
+    parser.add_argument('--output-dir', default='grounding_out', help='Directory for annotated screenshots')
+    parser.add_argument('--no-images', action='store_true', help='Do not save annotated screenshots')
+    parser.add_argument('--results', help='Results table (.jsonl or .csv), default <output-dir>/results.jsonl')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--rate', type=float, default=None, help='Max request starts per second')
+    parser.add_argument('--min-pixels', type=int, default=3136)
+    parser.add_argument('--max-pixels', type=int, default=12845056)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_dir = None if args.no_images else args.output_dir
+    results_path = args.results or os.path.join(args.output_dir, 'results.jsonl')
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    summary = run_batch(
+        load_tasks(args.manifest), args.model_id, results_path,
+        output_dir=output_dir, concurrency=args.concurrency, rate=args.rate,
+        min_pixels=args.min_pixels, max_pixels=args.max_pixels,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""视频 / 帧流分析：按采样率取帧，跳过与上一张送检帧几乎相同的帧，只把变化的帧交给模型
+
+帧源按需解码：视频文件和摄像头通过 OpenCV 读取（需要 opencv-python），截图目录按文件名顺序读取，
+加 --follow 可持续监视目录中新写入的截图。近似重复用感知哈希（dHash，64 位汉明距离）或
+缩略图平均差判断，每帧只需一次 9×8 / 32×32 的灰度缩放。送检的帧在线程池中分析，
+在途帧数不超过 --max-in-flight，结果按帧顺序逐行输出为 JSONL。
+
+    python frame_stream.py video.mp4 --fps 1 --prompt "画面里有没有人" --output events.jsonl
+    python frame_stream.py screenshots/ --follow --task grounding --prompt "点击登录按钮"
+    python frame_stream.py 0 --fps 2 --drop-when-busy     # 摄像头 0，模型忙时丢弃新帧
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from image_preprocess import IMAGE_FORMAT, IMAGE_QUALITY, MAX_PIXELS, MIN_PIXELS, smart_resize
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+
+def iter_video_frames(source, fps=1.0):
+    """按 fps 从视频文件或摄像头（整数编号）取帧，产出 (时间戳秒, PIL.Image)
+
+    未选中的帧只 grab 不 retrieve，跳过颜色转换和拷贝。
+    """
+    try:
+        import cv2
+    except ImportError:
+        raise SystemExit('读取视频或摄像头需要安装 opencv-python：pip install opencv-python')
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise SystemExit(f'无法打开视频源：{source}')
+    live = str(source).isdigit()
+    native_fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+    # 文件按帧号采样；摄像头的帧率不可靠，按实际时间采样
+    step = max(1, round(native_fps / fps)) if native_fps > 0 and fps else 1
+    started = time.monotonic()
+    next_time = 0.0
+    index = 0
+    try:
+        while capture.grab():
+            if live:
+                timestamp = time.monotonic() - started
+                selected = timestamp >= next_time
+                if selected:
+                    next_time = timestamp + (1.0 / fps if fps else 0.0)
+            else:
+                timestamp = index / native_fps if native_fps > 0 else float(index)
+                selected = index % step == 0
+            index += 1
+            if not selected:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+            yield timestamp, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        capture.release()
+
+
+def iter_directory_frames(directory, follow=False, poll_interval=0.5):
+    """按文件名顺序读取截图目录，产出 (文件修改时间, PIL.Image)；follow=True 时持续等待新文件"""
+    seen = set()
+    while True:
+        names = sorted(
+            name for name in os.listdir(directory)
+            if name not in seen and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        )
+        for name in names:
+            seen.add(name)
+            path = os.path.join(directory, name)
+            try:
+                image = Image.open(path)
+                image.load()
+            except OSError:
+                # 截图可能还没写完；持续监视时下一轮再读
+                if follow:
+                    seen.discard(name)
+                continue
+            yield os.path.getmtime(path), image
+        if not follow:
+            return
+        time.sleep(poll_interval)
+
+
+def iter_frames(source, fps=1.0, follow=False):
+    if os.path.isdir(source):
+        return iter_directory_frames(source, follow)
+    return iter_video_frames(source, fps)
+
+
+def dhash(image, hash_size=8):
+    """差值哈希：灰度缩放到 (hash_size+1)×hash_size，比较相邻像素，得到 hash_size² 位整数"""
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR),
+                        dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def thumbnail(image, size=32):
+    """灰度缩略图，用于平均差比较"""
+    return np.asarray(image.convert('L').resize((size, size), Image.Resampling.BILINEAR), dtype=np.float32)
+
+
+class FrameDeduplicator:
+    """判断一帧与上一张送检帧相比是否有变化
+
+    method='dhash' 比较感知哈希的汉明距离（threshold 为位数，默认 5/64），对压缩噪声和轻微亮度变化不敏感；
+    method='diff' 比较 32×32 灰度缩略图的平均绝对差（threshold 为 0–255 的灰度值），对局部小变化更敏感。
+    始终与上一张送检帧比较而不是上一帧，缓慢累积的变化最终也会触发送检。
+    refresh 秒内没有送检时强制送检一帧，None 为不强制。
+    """
+
+    def __init__(self, method='dhash', threshold=None, refresh=None):
+        if method not in ('dhash', 'diff'):
+            raise ValueError(f'unknown method: {method}')
+        self.method = method
+        self.threshold = threshold if threshold is not None else (5 if method == 'dhash' else 8.0)
+        self.refresh = refresh
+        self._reference = None
+        self._reference_time = None
+        self.seen = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def _signature(self, image):
+        return dhash(image) if self.method == 'dhash' else thumbnail(image)
+
+    def distance(self, signature):
+        if self._reference is None:
+            return None
+        if self.method == 'dhash':
+            return bin(signature ^ self._reference).count('1')
+        return float(np.abs(signature - self._reference).mean())
+
+    def check(self, image, timestamp):
+        """返回 (是否送检, 与上一张送检帧的距离)；第一帧总是送检"""
+        self.seen += 1
+        signature = self._signature(image)
+        distance = self.distance(signature)
+        changed = distance is None or distance > self.threshold
+        if not changed and self.refresh is not None and timestamp - self._reference_time >= self.refresh:
+            changed = True
+        if changed:
+            self._reference = signature
+            self._reference_time = timestamp
+            self.sent += 1
+        return changed, distance
+
+    def drop(self):
+        """记录一帧因在途帧已满被丢弃（未做比较）"""
+        self.seen += 1
+        self.dropped += 1
+
+    def stats(self):
+        return {
+            'seen': self.seen,
+            'sent': self.sent,
+            'skipped': self.seen - self.sent - self.dropped,
+            'dropped': self.dropped,
+            'skip_rate': round(1 - self.sent / self.seen, 4) if self.seen else 0.0,
+        }
+
+
+def encode_frame(image, min_pixels=MIN_PIXELS, max_pixels=MAX_PIXELS):
+    """已解码的帧按模型输入尺寸缩小后直接编码为 IMAGE_FORMAT，返回字节
+
+    入口函数只需解码这张已缩小的图，不再对整帧做无损编码、解码和缩放。编码是确定性的，
+    相同画面得到相同字节，结果缓存仍可命中。
+    """
+    height, width = smart_resize(image.height, image.width, min_pixels=min_pixels, max_pixels=max_pixels)
+    if width * height < image.width * image.height:
+        image = image.resize((width, height), Image.Resampling.BICUBIC)
+    if IMAGE_FORMAT == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def load_task(name, prompt, model_id=None):
+    """返回接收帧（PIL.Image）、返回模型输出文本的函数；入口模块按需导入，帧按该入口的像素上限编码"""
+    if name == 'describe':
+        app = importlib.import_module('app')
+        return lambda frame: app.analyze_image_with_qwen(
+            encode_frame(frame, app.UPLOAD_MIN_PIXELS, app.UPLOAD_MAX_PIXELS), prompt,
+        )
+    if name == 'grounding':
+        perform_gui_grounding_with_api = importlib.import_module('computer_use').perform_gui_grounding_with_api
+        model_id = model_id or 'qwen2.5-vl-7b-instruct'
+        # 与 perform_gui_grounding_with_api 默认的 min_pixels/max_pixels 一致
+        return lambda frame: perform_gui_grounding_with_api(
+            encode_frame(frame), prompt, model_id, output_path=None, verbose=False,
+        )[0]
+    raise ValueError(f'unknown task: {name}')
+
+
+def process(call, index, timestamp, image, distance):
+    started = time.perf_counter()
+    row = {'frame': index, 'timestamp': round(timestamp, 3), 'distance': distance,
+           'status': 'ok', 'result': None, 'error': None}
+    try:
+        row['result'] = call(image)
+    except Exception as e:
+        row.update(status='error', error=f'{type(e).__name__}: {e}')
+    row['latency'] = round(time.perf_counter() - started, 4)
+    return row
+
+
+def analyze_stream(frames, call, deduplicator=None, max_in_flight=4, drop_when_busy=False):
+    """逐帧去重后送检，按帧顺序产出结果行
+
+    在途帧达到 max_in_flight 时，默认等待最早的一帧完成（文件源不丢帧）；
+    drop_when_busy=True 时直接丢弃新到的帧（不做比较），适合实时源，结果延迟不会越积越大。
+    被丢弃的帧不更新去重基准，画面保持变化时下一帧仍会送检。
+    """
+    deduplicator = deduplicator or FrameDeduplicator()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='frame') as executor:
+        for index, (timestamp, image) in enumerate(frames):
+            # 先产出已完成的结果，保持顺序
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+            if drop_when_busy and len(pending) >= max_in_flight:
+                deduplicator.drop()
+                continue
+            changed, distance = deduplicator.check(image, timestamp)
+            if not changed:
+                continue
+            while len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(process, call, index, timestamp, image, distance))
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='视频文件、摄像头编号或截图目录')
+    parser.add_argument('--task', choices=['describe', 'grounding'], default='describe',
+                        help='describe 调用 app.analyze_image_with_qwen，grounding 调用 perform_gui_grounding_with_api')
+    parser.add_argument('--prompt', default='', help='提示词；grounding 时为操作指令')
+    parser.add_argument('--model', default=None, help='grounding 使用的模型')
+    parser.add_argument('--fps', type=float, default=1.0, help='视频采样率（帧/秒）')
+    parser.add_argument('--follow', action='store_true', help='持续监视截图目录中的新文件')
+    parser.add_argument('--method', choices=['dhash', 'diff'], default='dhash', help='近似重复判断方法')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='变化阈值：dhash 为汉明距离（默认 5），diff 为平均灰度差（默认 8）')
+    parser.add_argument('--refresh', type=float, default=None, help='画面不变时最长多少秒强制送检一次')
+    parser.add_argument('--max-in-flight', type=int, default=4, help='同时分析的帧数上限')
+    parser.add_argument('--drop-when-busy', action='store_true', help='在途帧已满时丢弃新帧而不是等待')
+    parser.add_argument('--output', default=None, help='结果 JSONL 文件，默认输出到标准输出')
+    args = parser.parse_args(argv)
+    if args.task == 'grounding' and not args.prompt:
+        parser.error('--task grounding 需要 --prompt')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    call = load_task(args.task, args.prompt, args.model)
+    deduplicator = FrameDeduplicator(args.method, args.threshold, args.refresh)
+    frames = iter_frames(args.source, args.fps, args.follow)
+    output = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    errors = 0
+    try:
+        for row in analyze_stream(frames, call, deduplicator, args.max_in_flight, args.drop_when_busy):
+            errors += row['status'] != 'ok'
+            output.write(json.dumps(row, ensure_ascii=False) + '\n')
+            output.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    summary = dict(deduplicator.stats(), errors=errors)
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""图片预处理：按模型的目标尺寸缩放后再编码，减少上传体积"""
+import base64
+import io
+import math
+import os
+import threading
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+# 重新编码使用的格式和质量，可通过环境变量调整（JPEG 或 WEBP）
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+
+# Qwen2.5-VL 的图片尺寸约束
+IMAGE_FACTOR = 28
+MIN_PIXELS = 4 * 28 * 28
+MAX_PIXELS = 16384 * 28 * 28
+MAX_RATIO = 200
+
+# PIL 格式名与实际应发送的 MIME 类型不一致的情况：MPO（手机多帧照片）的首帧就是普通 JPEG，
+# 服务端不认识 image/mpo
+SOURCE_MIME_TYPES = {'MPO': 'image/jpeg'}
+ORIENTATION_TAG = 0x0112  # EXIF Orientation
+# 这些 EXIF 方向需要旋转 90°，宽高互换
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def smart_resize(height, width, factor=IMAGE_FACTOR, min_pixels=MIN_PIXELS, max_pixels=MAX_PIXELS):
+    """与 Qwen2.5-VL 图像处理器一致的尺寸计算，返回 (height, width)
+
+    宽高都是 factor 的倍数，总像素落在 [min_pixels, max_pixels] 内，并尽量保持宽高比。
+    """
+    if max(height, width) / min(height, width) > MAX_RATIO:
+        raise ValueError(
+            f'absolute aspect ratio must be smaller than {MAX_RATIO}, got {max(height, width) / min(height, width)}'
+        )
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+@dataclass
+class PreparedImage:
+    """预处理结果"""
+    base64_data: str
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+    encoded_bytes: int
+
+    @property
+    def data_url(self):
+        return f'data:{self.mime_type};base64,{self.base64_data}'
+
+    @property
+    def bytes_saved(self):
+        return max(self.original_bytes - self.encoded_bytes, 0)
+
+
+class PreprocessStats:
+    """累计的原始字节数与实际发送字节数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.resized = 0
+        self.original_bytes = 0
+        self.encoded_bytes = 0
+
+    def record(self, prepared, resized):
+        with self._lock:
+            self.images += 1
+            self.resized += int(resized)
+            self.original_bytes += prepared.original_bytes
+            self.encoded_bytes += prepared.encoded_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'images': self.images,
+                'resized': self.resized,
+                'original_bytes': self.original_bytes,
+                'encoded_bytes': self.encoded_bytes,
+                'bytes_saved': max(self.original_bytes - self.encoded_bytes, 0),
+            }
+
+
+preprocess_stats = PreprocessStats()
+
+
+def read_image_bytes(image):
+    """读取文件路径、bytes 或文件对象中的全部字节"""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as image_file:
+            return image_file.read()
+    image.seek(0)
+    return image.read()
+
+
+def image_size(image):
+    """只解析文件头得到 (width, height)，不解码像素；文件对象读完后回到开头"""
+    if isinstance(image, Image.Image):
+        return image.size
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    if isinstance(image, (str, os.PathLike)):
+        with Image.open(image) as decoded:
+            return decoded.size
+    image.seek(0)
+    with Image.open(image) as decoded:
+        size = decoded.size
+    image.seek(0)
+    return size
+
+
+def _encode(image, image_format, quality):
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif image_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def prepare_image(image, target_size=None, min_pixels=None, max_pixels=None, image_format=None, quality=None,
+                  raw_bytes=None):
+    """把图片缩放到 target_size=(width, height) 后按指定格式重新编码
+
+    image 可以是文件路径、bytes、文件对象或已解码的 PIL.Image。
+    传入已解码的 PIL.Image 时可同时给出其原始字节 raw_bytes，避免重复读取和解码，且仍可直接发送原图。
+    未给出 target_size 但给出 max_pixels 时，按 smart_resize 计算目标尺寸。
+    刚解码的图片先按 EXIF 方向摆正；target_size 按文件中存储的方向给出，摆正时宽高互换的一并互换。
+    只缩小不放大（放大交给服务端）。未缩放、未旋转且重新编码反而更大时，直接发送原始字节，
+    并使用原图的真实 MIME 类型。
+    """
+    image_format = (image_format or IMAGE_FORMAT).upper()
+    quality = quality or IMAGE_QUALITY
+
+    raw = raw_bytes
+    if isinstance(image, Image.Image):
+        decoded = image
+    else:
+        raw = read_image_bytes(image)
+        decoded = Image.open(io.BytesIO(raw))
+    source_format = decoded.format
+
+    # 只处理从文件解码出的图片；裁剪、缩放得到的图片（format 为 None）的方向由调用方负责
+    transposed = False
+    if source_format is not None:
+        orientation = decoded.getexif().get(ORIENTATION_TAG, 1)
+        if orientation != 1:
+            decoded = ImageOps.exif_transpose(decoded)
+            transposed = True
+            if target_size and orientation in _TRANSPOSED_ORIENTATIONS:
+                target_size = (target_size[1], target_size[0])
+
+    if target_size is None and max_pixels is not None:
+        height, width = smart_resize(
+            decoded.height, decoded.width,
+            min_pixels=min_pixels or MIN_PIXELS, max_pixels=max_pixels,
+        )
+        target_size = (width, height)
+
+    resized = False
+    if target_size and target_size[0] * target_size[1] < decoded.width * decoded.height:
+        decoded = decoded.resize(target_size, Image.Resampling.BICUBIC)
+        resized = True
+
+    encoded = _encode(decoded, image_format, quality)
+    mime_type = Image.MIME[image_format]
+    if (raw is not None and not resized and not transposed and len(raw) <= len(encoded)
+            and source_format in Image.MIME):
+        encoded = raw
+        mime_type = SOURCE_MIME_TYPES.get(source_format, Image.MIME[source_format])
+
+    prepared = PreparedImage(
+        base64_data=base64.b64encode(encoded).decode('utf-8'),
+        mime_type=mime_type,
+        width=decoded.width,
+        height=decoded.height,
+        original_bytes=len(raw) if raw is not None else len(encoded),
+        encoded_bytes=len(encoded),
+    )
+    preprocess_stats.record(prepared, resized)
+    return prepared
@@ -1,11 +1,30 @@
 # -*- coding: utf-8 -*-
 import gradio as gr
-from mlx_vlm.generate import main as generate_main
-import sys
-from dataclasses import dataclass
+from mlx_vlm import load, generate
+try:
+    # 较新的 mlx_vlm 提供批量生成（内部对 prompt 做 padding 后一次前向）
+    from mlx_vlm import batch_generate
+except ImportError:
+    batch_generate = None
+try:
+    # 逐 token 产出生成结果（含 token id）
+    from mlx_vlm import stream_generate
+except ImportError:
+    stream_generate = None
+from PIL import Image
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from collections import deque
+from dataclasses import dataclass, field
+import functools
+import os
+import queue
 import re
-from io import StringIO
-import contextlib
+import sys
+import tempfile
+import threading
+import time
+
+from profiling import stage
 
 @dataclass
 class Args:
@@ -14,90 +33,377 @@ class Args:
     temp: float = 0.0
     prompt: str = "仔细分析描述这张图."
     image: str = None
+    warmup: bool = True  # 启动时先跑一次极短的生成，避免第一个请求承担编译开销
+    max_queue: int = 8  # 排队请求上限，超过后直接返回"繁忙"
+    request_timeout: float = 300.0  # 单个请求最长等待时间（秒），包含排队
+    # 微批大小上限，1 表示逐个推理；需要提供 batch_generate 的 mlx_vlm
+    max_batch_size: int = int(os.getenv("LOCAL_QWEN_MAX_BATCH_SIZE", "1"))
+    max_batch_wait: float = float(os.getenv("LOCAL_QWEN_MAX_BATCH_WAIT", "0.02"))  # 凑批最长等待时间（秒）
 
-@contextlib.contextmanager
-def capture_output():
-    # 创建StringIO对象来捕获输出
-    stdout, stderr = StringIO(), StringIO()
-    old_out, old_err = sys.stdout, sys.stderr
-    try:
-        sys.stdout, sys.stderr = stdout, stderr
-        yield stdout, stderr
-    finally:
-        sys.stdout, sys.stderr = old_out, old_err
-
-def extract_response(text):
-    if not text:  # 处理None或空字符串的情况
-        return "生成失败，请重试"
-    
-    # 清理特殊标记
-    text = re.sub(r'<\|vision_start\|><\|image_pad\|><\|vision_end\|><\|im_end\|>\s*<\|im_start\|>assistant\s*', '', text)
-    # 提取生成的文本内容
-    match = re.search(r'<\|im_start\|>assistant\s*(.*?)(?=\n=+\nPrompt:|$)', text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    return text
+class LocalQwen:
+    """常驻内存的 MLX 模型：权重只在启动时加载一次，之后直接通过 Python API 调用"""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model = None
+        self.processor = None
+        self._lock = threading.Lock()
+        self._warned_sequential = False
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                self.model, self.processor = load(self.model_path)
+        return self
+
+    def warmup(self):
+        # 用一张纯色小图生成 1 个 token，触发 Metal 内核编译和内存分配
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = os.path.join(tmp_dir, "warmup.png")
+            Image.new("RGB", (56, 56), "white").save(image_path)
+            self.generate(image_path, "hi", max_tokens=1, temp=0.0)
+
+    def generate_stream(self, image, prompt, max_tokens, temp):
+        """逐段产出生成的文本
+
+        按生成的 token id 增量解码：特殊 token 直接按 id 跳过，遇到结束 token 即停止，
+        每个 token 只解码末尾几个 id，不反复扫描已生成的全文。
+        """
+        if self.model is None:
+            self.load()
+        decoder = OutputDecoder(getattr(self.processor, "tokenizer", self.processor))
+        for response in stream_generate(
+            self.model,
+            self.processor,
+            format_prompt(prompt),
+            image=[image],
+            max_tokens=max_tokens,
+            temp=temp,
+        ):
+            token = getattr(response, "token", None)
+            if token is None:
+                # 旧版 mlx_vlm 只产出文本片段
+                yield getattr(response, "text", response)
+                continue
+            delta = decoder.feed(int(token))
+            if delta:
+                yield delta
+            if decoder.finished:
+                break
+        tail = decoder.flush()
+        if tail:
+            yield tail
+
+    def generate(self, image, prompt, max_tokens, temp):
+        if stream_generate is not None:
+            return "".join(self.generate_stream(image, prompt, max_tokens, temp)).strip()
+        if self.model is None:
+            self.load()
+        result = generate(
+            self.model,
+            self.processor,
+            format_prompt(prompt),
+            image=[image],
+            max_tokens=max_tokens,
+            temp=temp,
+            verbose=False,
+        )
+        # 新版 mlx_vlm 返回 GenerationResult，旧版直接返回字符串
+        return getattr(result, "text", result).strip()
+
+    def generate_batch(self, images, prompts, max_tokens, temp):
+        """同一组 max_tokens/temp 的请求一次生成，返回与输入顺序一致的结果列表"""
+        if len(images) == 1 or batch_generate is None:
+            if len(images) > 1 and not self._warned_sequential:
+                # 当前 mlx_vlm 不支持批量生成时退化为逐个生成，只提示一次
+                self._warned_sequential = True
+                print("警告：mlx_vlm 没有 batch_generate，微批请求改为逐个生成；"
+                      "请升级 mlx_vlm 或把 LOCAL_QWEN_MAX_BATCH_SIZE 设为 1", file=sys.stderr)
+            return [self.generate(image, prompt, max_tokens, temp) for image, prompt in zip(images, prompts)]
+        if self.model is None:
+            self.load()
+        result = batch_generate(
+            self.model,
+            self.processor,
+            images=images,
+            prompts=[format_prompt(prompt) for prompt in prompts],
+            max_tokens=max_tokens,
+            temp=temp,
+            verbose=False,
+        )
+        texts = getattr(result, "texts", result)
+        return [text.strip() for text in texts]
+
+class OutputDecoder:
+    """把生成的 token id 增量解码为文本
+
+    只解码上次输出位置之前几个 id 到末尾的窗口（与 vLLM 的增量反分词相同），每个 token 的开销是常数，
+    不随输出长度增长。特殊 token 按 id 跳过，不进入解码；遇到结束 token 后 finished 为 True。
+    多字节字符被拆在多个 token 里时，等字符完整后再输出。
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.special_ids = frozenset(getattr(tokenizer, "all_special_ids", ()))
+        stop_ids = {getattr(tokenizer, "eos_token_id", None)}
+        if hasattr(tokenizer, "convert_tokens_to_ids"):
+            stop_ids.add(tokenizer.convert_tokens_to_ids("<|im_end|>"))
+        self.stop_ids = frozenset(i for i in stop_ids if isinstance(i, int))
+        self.finished = False
+        self._ids = []
+        self._prefix = 0  # 解码窗口的起点
+        self._read = 0  # 已输出到的位置
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids) if ids else ""
+
+    def feed(self, token_id):
+        """输入一个 token id，返回新增的文本（可能为空字符串）"""
+        if self.finished:
+            return ""
+        if token_id in self.stop_ids:
+            self.finished = True
+            return ""
+        if token_id in self.special_ids:
+            return ""
+        self._ids.append(token_id)
+        prefix_text = self._decode(self._ids[self._prefix:self._read])
+        new_text = self._decode(self._ids[self._prefix:])
+        # 末尾是不完整的 UTF-8 字符时先不输出
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix, self._read = self._read, len(self._ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """生成结束时输出尚未输出的部分"""
+        if self._read == len(self._ids):
+            return ""
+        prefix_text = self._decode(self._ids[self._prefix:self._read])
+        new_text = self._decode(self._ids[self._prefix:])
+        self._prefix = self._read = len(self._ids)
+        return new_text[len(prefix_text):]
+
+_CHINESE_CHAR = re.compile("[\u4e00-\u9fff]")
+
+SYSTEM_PROMPTS = {
+    "zh": "你是一个中文AI助手。请用中文回答问题。",
+    "en": "You are an English AI assistant. Please answer in English.",
+}
 
 def is_chinese(text):
     # 检查文本是否包含中文字符
-    for char in text:
-        if '\u4e00' <= char <= '\u9fff':
-            return True
-    return False
+    return _CHINESE_CHAR.search(text) is not None
+
+@functools.lru_cache(maxsize=32)
+def prompt_template(language, system_prompt=None):
+    """按语言和系统提示词缓存的对话模板，返回用户提示词前后的两段固定文本"""
+    if system_prompt is None:
+        system_prompt = SYSTEM_PROMPTS[language]
+    prefix = (
+        f"<|im_start|>system\n{system_prompt}\n<|im_end|>\n"
+        "<|im_start|>user\n<|vision_start|><|image_pad|><|vision_end|>"
+    )
+    suffix = "\n<|im_end|>\n<|im_start|>assistant\n"
+    return prefix, suffix
 
-def format_prompt(prompt):
+def format_prompt(prompt, system_prompt=None):
     # 根据用户输入自动判断语言
-    use_chinese = is_chinese(prompt)
-    
-    if use_chinese:
-        system_prompt = """你是一个中文AI助手。请用中文回答问题。"""
-    else:
-        system_prompt = """You are an English AI assistant. Please answer in English."""
-    
-    return f"""<|im_start|>system
-{system_prompt}
-<|im_end|>
-<|im_start|>user
-{prompt}
-<|im_end|>
-<|im_start|>assistant
-"""
+    prefix, suffix = prompt_template("zh" if is_chinese(prompt) else "en", system_prompt)
+    return prefix + prompt + suffix
+
+class SchedulerBusy(Exception):
+    """请求队列已满"""
+
+@dataclass
+class InferenceRequest:
+    image: str
+    prompt: str
+    max_tokens: int
+    temp: float
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+class BatchStats:
+    """微批指标：批次填充率和排队延迟"""
+
+    def __init__(self, max_batch_size):
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    def record(self, batch, started_at):
+        delays = [started_at - request.enqueued_at for request in batch]
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.total_queue_delay += sum(delays)
+            self.max_queue_delay = max(self.max_queue_delay, max(delays))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "batch_fill_ratio": self.requests / (self.batches * self.max_batch_size) if self.batches else 0.0,
+                "mean_queue_delay": self.total_queue_delay / self.requests if self.requests else 0.0,
+                "max_queue_delay": self.max_queue_delay,
+            }
+
+class InferenceScheduler:
+    """有界请求队列 + 独占模型的推理线程，每个请求通过自己的 Future 取回结果
+
+    max_batch_size > 1 时开启微批：取到第一个请求后最多再等 max_batch_wait 秒，
+    把 max_tokens 和 temp 相同的请求凑成一批；不兼容的请求留到下一批。
+    max_queue 限制已提交但还没被取出执行的请求数，包括凑批时留下的请求。
+    """
+
+    def __init__(self, engine, max_queue=Args.max_queue, max_batch_size=Args.max_batch_size,
+                 max_batch_wait=Args.max_batch_wait):
+        self.engine = engine
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_wait = max_batch_wait
+        self.stats = BatchStats(self.max_batch_size)
+        self.max_queue = max_queue
+        # 准入按 _pending 计数；请求移入 _deferred 后仍占名额，直到被取出执行
+        self._queue = queue.Queue()
+        self._deferred = deque()  # 凑批时遇到的不兼容请求，只由推理线程访问
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._stopping = False
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="mlx-inference", daemon=True)
+                self._worker.start()
+        return self
+
+    def submit(self, image, prompt, max_tokens, temp):
+        """提交请求，队列已满时抛出 SchedulerBusy"""
+        self.start()
+        request = InferenceRequest(image, prompt, max_tokens, temp)
+        with self._pending_lock:
+            if 0 < self.max_queue <= self._pending:
+                raise SchedulerBusy(f"queue is full ({self._pending} pending)")
+            self._pending += 1
+        self._queue.put_nowait(request)
+        return request.future
+
+    @property
+    def depth(self):
+        """排队中的请求数（含凑批时留下的请求）"""
+        with self._pending_lock:
+            return self._pending
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _next_batch(self):
+        if self._deferred:
+            first = self._deferred.popleft()
+        elif self._stopping:
+            return None
+        else:
+            first = self._queue.get()
+            if first is None:
+                return None
+        batch = [first]
+        settings = (first.max_tokens, first.temp)
+
+        # 先从之前留下的请求里找兼容的
+        for request in list(self._deferred):
+            if len(batch) >= self.max_batch_size:
+                break
+            if (request.max_tokens, request.temp) == settings:
+                self._deferred.remove(request)
+                batch.append(request)
+
+        deadline = time.monotonic() + self.max_batch_wait
+        while len(batch) < self.max_batch_size and not self._stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stopping = True
+            elif (request.max_tokens, request.temp) == settings:
+                batch.append(request)
+            else:
+                self._deferred.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            # 请求离开调度器后才释放排队名额
+            with self._pending_lock:
+                self._pending -= len(batch)
+            # 已被取消（等待超时）的请求直接跳过
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self.stats.record(batch, time.monotonic())
+            try:
+                outputs = self.engine.generate_batch(
+                    [request.image for request in batch],
+                    [request.prompt for request in batch],
+                    batch[0].max_tokens,
+                    batch[0].temp,
+                )
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            else:
+                for request, output in zip(batch, outputs):
+                    request.future.set_result(output)
+
+engine = LocalQwen(Args.model)
+scheduler = InferenceScheduler(engine)
 
 def process_image(image, prompt, max_tokens, temp):
     if not image:
         return "请先上传图片" if is_chinese(prompt) else "Please upload an image first"
-        
-    # 保存原始参数
-    old_argv = sys.argv[:]
-    
-    # 构建新的命令行参数
-    sys.argv = [
-        sys.argv[0],
-        "--model", Args.model,
-        "--max-tokens", str(max_tokens),
-        "--temp", str(temp),
-        "--prompt", format_prompt(prompt),
-        "--image", image
-    ]
-    
+
     try:
-        # 捕获输出
-        with capture_output() as (out, err):
-            generate_main()
-            output = out.getvalue()
-        
+        future = scheduler.submit(image, prompt, int(max_tokens), float(temp))
+    except SchedulerBusy:
+        return "服务繁忙，请稍后重试" if is_chinese(prompt) else "Server is busy, please try again later"
+
+    try:
+        with stage("inference"):
+            output = future.result(timeout=Args.request_timeout)
         if not output:
             return "生成失败，请重试"
-            
-        # 提取有效的回复内容
-        return extract_response(output)
+        return output
+    except FutureTimeout:
+        future.cancel()
+        return "请求超时，请稍后重试" if is_chinese(prompt) else "Request timed out, please try again later"
     except Exception as e:
         return f"发生错误: {str(e)}"
-    finally:
-        # 恢复原始参数
-        sys.argv = old_argv
 
-demo = gr.Interface(
+def scheduler_stats():
+    # 微批填充率、排队延迟和当前排队数，用于调整 LOCAL_QWEN_MAX_BATCH_SIZE / LOCAL_QWEN_MAX_BATCH_WAIT
+    return dict(
+        scheduler.stats.snapshot(),
+        queue_depth=scheduler.depth,
+        max_batch_size=scheduler.max_batch_size,
+        max_batch_wait=scheduler.max_batch_wait,
+        batch_generate=batch_generate is not None,
+    )
+
+analysis = gr.Interface(
     fn=process_image,
     inputs=[
         gr.Image(type="filepath", label="上传图片"),
@@ -110,5 +416,22 @@ demo = gr.Interface(
     description="上传图片并输入提示词，AI将根据提示词语言自动选择回复语言"
 )
 
+stats = gr.Interface(
+    fn=scheduler_stats,
+    inputs=[],
+    outputs=gr.JSON(label="调度统计"),
+    title="推理调度统计",
+    description="批次数、平均批大小、填充率和排队延迟（秒）",
+)
+
+demo = gr.TabbedInterface([analysis, stats], ["图像分析", "调度统计"])
+
 if __name__ == "__main__":
+    # 启动时加载模型并预热，之后的请求直接复用
+    engine.load()
+    if Args.warmup:
+        engine.warmup()
+    scheduler.start()
+    # 允许多个请求同时进入 process_image，由调度器统一排队和限流
+    demo.queue(default_concurrency_limit=Args.max_queue)
     demo.launch(share=False) 
\ No newline at end of file
@@ -0,0 +1,373 @@
+"""进程内指标，按 Prometheus 文本格式导出（/metrics）
+
+不依赖 prometheus_client：计数器、仪表和直方图都是加锁的字典，记录一次只需一次加锁和几次加法。
+其他模块已有的统计（结果缓存、连接池、预处理）通过 register_collector 在导出时读取，不重复计数。
+多进程部署时调用 enable_multiprocess(目录)：每个 worker 定期把自己的指标写入目录，
+任一 worker 的 /metrics 导出所有 worker 的合计。/usage、/router_stats 这类 JSON 统计通过
+register_section 随快照一起写出，由 worker_sections 读取各 worker 的值。
+"""
+import atexit
+import bisect
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+# 秒级延迟的默认分桶，覆盖毫秒级编码到分钟级生成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 上传大小分桶：16KB 到 64MB
+SIZE_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(7))
+
+_registry = []
+_collectors = []
+_sections = {}  # 名称 -> 返回可 JSON 序列化数据的函数
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return tuple(zip(self.labelnames, key)) + extra
+
+    def state(self):
+        """可序列化、可跨进程相加的原始值：[[标签值列表, 数值]]"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def samples(self):
+        """返回 [(样本名, ((标签名, 值), ...), 数值)]"""
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 各桶的非累计计数（最后一格为 +Inf）、总和、样本数
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def state(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', self._labels(key, ('le', _format_value(float(bound)))), cumulative))
+            samples.append((f'{self.name}_sum', self._labels(key), total))
+            samples.append((f'{self.name}_count', self._labels(key), count))
+        return samples
+
+
+class _MergedMetric:
+    """多个进程的同名指标相加后的结果，只用于导出"""
+
+    def __init__(self, metric_class, name, documentation, labelnames, buckets=None):
+        self.metric_type = metric_class.metric_type
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self._lock = threading.Lock()
+        self._values = {}
+        self._samples = metric_class.samples
+
+    _labels = _Metric._labels
+
+    def add(self, values):
+        for key, value in values:
+            key = tuple(key)
+            current = self._values.get(key)
+            if current is None:
+                self._values[key] = [list(value[0]), value[1], value[2]] if self.buckets else value
+            elif self.buckets:
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+            else:
+                self._values[key] = current + value
+
+    def samples(self):
+        return self._samples(self)
+
+
+def register_collector(collect):
+    """注册在导出时调用的函数，返回 [(指标名, 类型, 说明, 数值)]，用于导出已有模块自己维护的统计"""
+    with _registry_lock:
+        _collectors.append(collect)
+
+
+def register_section(name, collect):
+    """注册随多进程快照写出的附加统计，collect 返回可 JSON 序列化的数据"""
+    with _registry_lock:
+        _sections[name] = collect
+
+
+def worker_sections(name, include_exited=False):
+    """各 worker 最近写出的 name 统计 {pid: 数据}；本进程的值为当前值
+
+    非多进程模式时只有当前进程。include_exited=True 时包含已退出 worker 最后写出的值（用于累计量）。
+    """
+    with _registry_lock:
+        collect = _sections[name]
+    sections = {}
+    if _multiprocess_dir is not None:
+        for state in _read_snapshots():
+            if name in state.get('sections', {}) and (include_exited or _alive(state['pid'])):
+                sections[state['pid']] = state['sections'][name]
+    sections[os.getpid()] = collect()
+    return sections
+
+
+def _collected():
+    with _registry_lock:
+        collectors = list(_collectors)
+    return [list(item) for collect in collectors for item in collect()]
+
+
+def _format(metrics, collected):
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    for name, metric_type, documentation, value in collected:
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def render():
+    """按 Prometheus 文本格式（0.0.4）导出全部指标；多进程模式下导出所有 worker 的合计"""
+    if _multiprocess_dir is not None:
+        write_snapshot()
+        return _format(*_merge(_read_snapshots()))
+    with _registry_lock:
+        metrics = list(_registry)
+    return _format(metrics, _collected())
+
+
+_METRIC_CLASSES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+_multiprocess_dir = None
+_flusher = None
+
+
+def snapshot():
+    """当前进程全部指标的原始值，供其他进程合并"""
+    with _registry_lock:
+        metrics = list(_registry)
+    return {
+        'pid': os.getpid(),
+        'metrics': [{
+            'name': metric.name,
+            'type': metric.metric_type,
+            'documentation': metric.documentation,
+            'labelnames': list(metric.labelnames),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'values': metric.state(),
+        } for metric in metrics],
+        'collected': _collected(),
+        'sections': {name: collect() for name, collect in _sections_items()},
+    }
+
+
+def _sections_items():
+    with _registry_lock:
+        return list(_sections.items())
+
+
+def write_snapshot():
+    """把当前进程的指标写入多进程目录（先写临时文件再改名，读取方不会读到一半）"""
+    if _multiprocess_dir is None:
+        return
+    path = os.path.join(_multiprocess_dir, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def _read_snapshots():
+    states = []
+    for filename in sorted(os.listdir(_multiprocess_dir)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(_multiprocess_dir, filename), encoding='utf-8') as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return states
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(states):
+    """按指标名和标签相加；已退出进程的计数器和直方图保留（保持单调），仪表只计存活进程"""
+    merged = {}
+    collected = {}
+    for state in states:
+        alive = _alive(state['pid'])
+        for item in state['metrics']:
+            if item['type'] == 'gauge' and not alive:
+                continue
+            metric = merged.get(item['name'])
+            if metric is None:
+                metric = merged[item['name']] = _MergedMetric(
+                    _METRIC_CLASSES[item['type']], item['name'], item['documentation'],
+                    item['labelnames'], item['buckets'] if item['type'] == 'histogram' else None,
+                )
+            metric.add(item['values'])
+        for name, metric_type, documentation, value in state['collected']:
+            if metric_type == 'gauge' and not alive:
+                continue
+            if name in collected:
+                collected[name][3] += value
+            else:
+                collected[name] = [name, metric_type, documentation, value]
+    return list(merged.values()), list(collected.values())
+
+
+def enable_multiprocess(directory, interval=1.0):
+    """在每个 worker 进程中调用：之后每 interval 秒和进程退出时写出本进程的指标
+
+    其他 worker 的数据最多滞后 interval 秒；目录由主进程在启动 worker 前清空。
+    """
+    global _multiprocess_dir, _flusher
+    _multiprocess_dir = directory
+    atexit.register(write_snapshot)
+
+    def flush():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot()
+            except OSError:
+                pass
+
+    _flusher = threading.Thread(target=flush, name='metrics-flush', daemon=True)
+    _flusher.start()
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# HTTP 层
+HTTP_REQUESTS = Counter('qwen_http_requests_total', 'HTTP requests by endpoint, method and status',
+                        ('endpoint', 'method', 'status'))
+HTTP_LATENCY = Histogram('qwen_http_request_duration_seconds', 'HTTP request duration including streaming',
+                         ('endpoint',))
+IN_FLIGHT = Gauge('qwen_http_requests_in_flight', 'HTTP requests currently being served')
+UPLOAD_SIZE = Histogram('qwen_upload_size_bytes', 'Size of each uploaded image', buckets=SIZE_BUCKETS)
+ENCODE_LATENCY = Histogram('qwen_image_encode_seconds', 'Image resize and re-encode time')
+
+# 上游（魔搭 / 百炼）
+UPSTREAM_LATENCY = Histogram('qwen_upstream_request_seconds', 'Upstream chat completion time, full body',
+                             ('host', 'stream'))
+UPSTREAM_TTFT = Histogram('qwen_upstream_ttft_seconds', 'Time from upstream request to first streamed token',
+                          ('host',))
+UPSTREAM_ERRORS = Counter('qwen_upstream_errors_total', 'Upstream errors by exception type',
+                          ('host', 'type'))
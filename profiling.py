@@ -0,0 +1,31 @@
+"""按阶段计时：只有在 record_stages() 内调用时才记录，平时几乎没有开销"""
+import contextlib
+import contextvars
+import time
+
+_timings = contextvars.ContextVar('stage_timings', default=None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """统计代码块耗时，累加到当前 record_stages() 的结果里"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def record_stages():
+    """在当前上下文（线程）中收集各阶段耗时，产出 {阶段名: 秒}"""
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
@@ -0,0 +1,311 @@
+"""共享的 OpenAI 兼容客户端：按 base_url 复用长连接池"""
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from metrics import UPSTREAM_ERRORS, UPSTREAM_LATENCY, UPSTREAM_TTFT
+from profiling import stage
+from rate_limit import get_limiter
+
+# 各平台的 OpenAI 兼容接口地址，可通过环境变量覆盖（例如指向本地代理）
+MODELSCOPE_BASE_URL = os.getenv('MODELSCOPE_BASE_URL', 'https://api-inference.modelscope.cn/v1/')
+DASHSCOPE_BASE_URL = os.getenv('DASHSCOPE_BASE_URL', 'https://dashscope.aliyuncs.com/compatible-mode/v1')
+
+
+@dataclass
+class PoolConfig:
+    """连接池与超时配置（限速、并发和重试见 rate_limit.LimitConfig）"""
+    max_connections: int = field(default_factory=lambda: int(os.getenv('QWEN_POOL_SIZE', '32')))
+    max_keepalive_connections: int = field(default_factory=lambda: int(os.getenv('QWEN_POOL_KEEPALIVE', '32')))
+    keepalive_expiry: float = field(default_factory=lambda: float(os.getenv('QWEN_KEEPALIVE_EXPIRY', '60')))
+    connect_timeout: float = field(default_factory=lambda: float(os.getenv('QWEN_CONNECT_TIMEOUT', '10')))
+    read_timeout: float = field(default_factory=lambda: float(os.getenv('QWEN_READ_TIMEOUT', '300')))
+
+
+class PoolStats:
+    """统计连接池的复用情况：新建连接数 / 请求数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def _trace(self, event_name, info):
+        # httpcore 的 trace 回调，只有新建连接才会触发 connect/start_tls 事件
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.new_connections += 1
+        elif event_name == 'connection.start_tls.complete':
+            with self._lock:
+                self.tls_handshakes += 1
+
+    async def _atrace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self._trace
+
+    async def on_request_async(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self._atrace
+
+    def snapshot(self):
+        with self._lock:
+            requests = self.requests
+            new_connections = self.new_connections
+            tls_handshakes = self.tls_handshakes
+        reused = max(requests - new_connections, 0)
+        return {
+            'requests': requests,
+            'new_connections': new_connections,
+            'tls_handshakes': tls_handshakes,
+            'reused_connections': reused,
+            'reuse_ratio': reused / requests if requests else 0.0,
+        }
+
+
+_lock = threading.Lock()
+_http_clients = {}  # base_url -> httpx.Client
+_stats = {}  # base_url -> PoolStats
+_clients = {}  # (base_url, api_key) -> OpenAI
+_async_http_clients = {}  # base_url -> httpx.AsyncClient
+_async_clients = {}  # (base_url, api_key) -> AsyncOpenAI
+
+
+def _pool_options(config):
+    return {
+        'limits': httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        'timeout': httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+    }
+
+
+def _build_http_client(base_url, config):
+    stats = _stats.setdefault(base_url, PoolStats())
+    return httpx.Client(event_hooks={'request': [stats.on_request]}, **_pool_options(config))
+
+
+def _build_async_http_client(base_url, config):
+    # 同步和异步连接池的统计合并到同一个 base_url 下
+    stats = _stats.setdefault(base_url, PoolStats())
+    return httpx.AsyncClient(event_hooks={'request': [stats.on_request_async]}, **_pool_options(config))
+
+
+def get_client(base_url, api_key=None, config=None):
+    """获取共享客户端；同一 base_url 的所有调用共用一个连接池
+
+    config 只在第一次创建该 base_url 的连接池时生效。
+    api_key 为 None 时沿用 openai SDK 的默认行为（读取 OPENAI_API_KEY）。
+    """
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            config = config or PoolConfig()
+            http_client = _http_clients.get(base_url)
+            if http_client is None:
+                http_client = _http_clients[base_url] = _build_http_client(base_url, config)
+            client = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=0,  # 重试由 rate_limit 统一处理，与并发控制共享退避状态
+                http_client=http_client,
+            )
+            _clients[key] = client
+    return client
+
+
+def get_async_client(base_url, api_key=None, config=None):
+    """获取共享的 AsyncOpenAI 客户端，用于在事件循环中等待上游 I/O
+
+    异步连接池绑定创建它的事件循环，一个进程只应在一个事件循环中使用。
+    """
+    key = (base_url, api_key)
+    client = _async_clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _async_clients.get(key)
+        if client is None:
+            config = config or PoolConfig()
+            http_client = _async_http_clients.get(base_url)
+            if http_client is None:
+                http_client = _async_http_clients[base_url] = _build_async_http_client(base_url, config)
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=0,  # 重试由 rate_limit 统一处理，与并发控制共享退避状态
+                http_client=http_client,
+            )
+            _async_clients[key] = client
+    return client
+
+
+class _MeteredStream:
+    """包装流式响应：记录首 token 时间、完整耗时和读取过程中的错误，结束时回调 on_finish，其余属性透传"""
+
+    def __init__(self, stream, host, started, on_finish):
+        self._stream = stream
+        self._host = host
+        self._started = started
+        self._on_finish = on_finish
+        self._first_token = False
+        self._finished = False
+
+    def _on_chunk(self, chunk):
+        if not self._first_token and chunk.choices and chunk.choices[0].delta.content:
+            self._first_token = True
+            UPSTREAM_TTFT.observe(time.perf_counter() - self._started, host=self._host)
+
+    def _finish(self, error=None):
+        if self._finished:
+            return
+        self._finished = True
+        if error is not None:
+            UPSTREAM_ERRORS.inc(host=self._host, type=type(error).__name__)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - self._started, host=self._host, stream='true')
+        # 流读完或关闭时才归还并发名额
+        self._on_finish(error)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._finish()
+
+    def close(self):
+        self._finish()
+        self._stream.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _MeteredAsyncStream(_MeteredStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._finish()
+
+    async def close(self):
+        self._finish()
+        await self._stream.close()
+
+
+def _host(base_url):
+    return urlparse(base_url).netloc or base_url
+
+
+def create_chat_completion(base_url, api_key=None, max_retries=None, **kwargs):
+    """通过共享客户端调用 chat.completions.create
+
+    先在本地排队等待令牌和并发名额；可重试的错误（429、5xx、连接失败）按 Retry-After 或抖动退避后重试。
+    max_retries 为 None 时使用 QWEN_MAX_RETRIES；还有其他后端可切换时路由层传 0，出错立即转移。
+    """
+    client = get_client(base_url, api_key)
+    host = _host(base_url)
+    limiter = get_limiter(host)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            with stage('upstream'):
+                response = client.chat.completions.create(**kwargs)
+            break
+        except Exception as e:
+            limiter.release(e)
+            UPSTREAM_ERRORS.inc(host=host, type=type(e).__name__)
+            delay = limiter.backoff(e, attempt, max_retries)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+    if kwargs.get('stream'):
+        return _MeteredStream(response, host, started, limiter.release)
+    limiter.release()
+    UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host, stream='false')
+    return response
+
+
+async def create_chat_completion_async(base_url, api_key=None, max_retries=None, **kwargs):
+    """通过共享异步客户端调用 chat.completions.create，排队与重试规则同 create_chat_completion"""
+    client = get_async_client(base_url, api_key)
+    host = _host(base_url)
+    limiter = get_limiter(host)
+    attempt = 0
+    while True:
+        await limiter.acquire_async()
+        started = time.perf_counter()
+        try:
+            with stage('upstream'):
+                response = await client.chat.completions.create(**kwargs)
+            break
+        except BaseException as e:
+            # 任务被取消时也要归还名额
+            limiter.release(e if isinstance(e, Exception) else None)
+            if not isinstance(e, Exception):
+                raise
+            UPSTREAM_ERRORS.inc(host=host, type=type(e).__name__)
+            delay = limiter.backoff(e, attempt, max_retries)
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+    if kwargs.get('stream'):
+        return _MeteredAsyncStream(response, host, started, limiter.release)
+    limiter.release()
+    UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host, stream='false')
+    return response
+
+
+def pool_stats():
+    """返回各 base_url 的连接复用统计"""
+    with _lock:
+        items = list(_stats.items())
+    return {base_url: stats.snapshot() for base_url, stats in items}
+
+
+def close_clients():
+    """关闭所有同步连接池（进程退出或测试时使用）"""
+    with _lock:
+        http_clients = list(_http_clients.values())
+        _http_clients.clear()
+        _clients.clear()
+    for http_client in http_clients:
+        http_client.close()
+
+
+async def close_async_clients():
+    """关闭所有异步连接池（在事件循环退出前调用）"""
+    with _lock:
+        http_clients = list(_async_http_clients.values())
+        _async_http_clients.clear()
+        _async_clients.clear()
+    for http_client in http_clients:
+        await http_client.aclose()
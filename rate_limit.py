@@ -0,0 +1,297 @@
+"""上游配额控制：令牌桶限速 + AIMD 自适应并发 + 遵循 Retry-After 的抖动退避
+
+每个 base_url 一个 UpstreamLimiter，由 qwen_client 的所有调用共享。
+请求先在本地短暂排队（最多 QWEN_QUEUE_TIMEOUT 秒）等待令牌和并发名额，超时才失败；
+收到 429/503 时并发上限减半并暂停发放令牌，成功时缓慢回升，吞吐稳定在配额上限附近。
+限速状态按进程保存；serve.py 多进程部署时每个 worker 调用 split_across_processes，
+速率和并发上限按 worker 数分摊，所有 worker 合计不超过配置值。
+"""
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field, replace
+
+import openai
+
+from metrics import Counter, Gauge, Histogram
+
+UPSTREAM_RETRIES = Counter('qwen_upstream_retries_total', 'Upstream calls retried after a retryable error',
+                           ('host', 'reason'))
+CONCURRENCY_LIMIT = Gauge('qwen_upstream_concurrency_limit', 'Current adaptive upstream concurrency limit',
+                          ('host',))
+QUEUE_WAIT = Histogram('qwen_upstream_queue_wait_seconds', 'Time spent waiting for a rate/concurrency slot',
+                       ('host',))
+
+
+class UpstreamBusy(Exception):
+    """在 queue_timeout 内没有拿到令牌或并发名额"""
+
+
+@dataclass
+class LimitConfig:
+    """限速、并发与重试配置"""
+    rate: float = field(default_factory=lambda: float(os.getenv('QWEN_RATE_LIMIT', '0')))  # 每秒请求数，0 为不限
+    burst: int = field(default_factory=lambda: int(os.getenv('QWEN_RATE_BURST', '1')))
+    initial_concurrency: int = field(default_factory=lambda: int(os.getenv('QWEN_INITIAL_CONCURRENCY', '8')))
+    min_concurrency: int = field(default_factory=lambda: int(os.getenv('QWEN_MIN_CONCURRENCY', '1')))
+    max_concurrency: int = field(default_factory=lambda: int(os.getenv('QWEN_MAX_CONCURRENCY', '32')))
+    queue_timeout: float = field(default_factory=lambda: float(os.getenv('QWEN_QUEUE_TIMEOUT', '30')))
+    max_retries: int = field(default_factory=lambda: int(os.getenv('QWEN_MAX_RETRIES', '3')))
+    backoff_base: float = field(default_factory=lambda: float(os.getenv('QWEN_BACKOFF_BASE', '0.5')))
+    backoff_max: float = field(default_factory=lambda: float(os.getenv('QWEN_BACKOFF_MAX', '30')))
+
+    def split(self, processes):
+        """processes 个进程各自使用的份额；并发上限每个进程至少为 1"""
+        if processes <= 1:
+            return self
+        return replace(
+            self,
+            rate=self.rate / processes,
+            burst=max(1, self.burst // processes),
+            initial_concurrency=max(1, self.initial_concurrency // processes),
+            min_concurrency=max(1, self.min_concurrency // processes),
+            max_concurrency=max(1, self.max_concurrency // processes),
+        )
+
+
+class TokenBucket:
+    """令牌桶；reserve() 预订一个令牌并返回需要等待的秒数，同步和异步调用方各自睡眠"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def reserve(self):
+        if not self.rate or self.rate <= 0:
+            return max(self._paused_until - time.monotonic(), 0.0)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            # 令牌为负表示已被预订，需要等待补足
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def cancel(self):
+        """退还 reserve() 预订但没有使用的令牌"""
+        if self.rate and self.rate > 0:
+            with self._lock:
+                self._tokens = min(self.burst, self._tokens + 1)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """上游要求稍后重试时，暂停发放令牌"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 并发上限：成功一次上限加 1/limit（约每轮加 1），过载时减半（每个冷却期最多一次）"""
+
+    def __init__(self, initial=8, minimum=1, maximum=32, decrease_factor=0.5, cooldown=1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self, timeout):
+        # 名额由线程和协程共享，协程侧用短间隔轮询，不阻塞事件循环
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+
+    def release(self, overloaded=False, succeeded=False):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+            return self.limit
+
+
+def retry_after(error):
+    """读取上游响应中的 Retry-After（retry-after-ms、秒数或 HTTP 日期），没有时返回 None"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(parsed.timestamp() - time.time(), 0.0)
+
+
+def is_overload(error):
+    """429/503：上游配额或容量不足，需要降低并发"""
+    return isinstance(error, openai.APIStatusError) and error.status_code in (429, 503)
+
+
+def is_retryable(error):
+    # 与 openai SDK 默认的重试条件一致
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class UpstreamLimiter:
+    """一个上游地址的限速器、并发限制器和重试策略"""
+
+    def __init__(self, host, config=None):
+        self.host = host
+        self.config = config or LimitConfig()
+        self.bucket = TokenBucket(self.config.rate, self.config.burst)
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            self.config.initial_concurrency, self.config.min_concurrency, self.config.max_concurrency,
+        )
+        CONCURRENCY_LIMIT.set(self.concurrency.limit, host=host)
+
+    def acquire(self):
+        """同步等待令牌和并发名额，超过 queue_timeout 抛出 UpstreamBusy"""
+        start = time.monotonic()
+        delay = self.bucket.reserve()
+        if delay > self.config.queue_timeout:
+            self.bucket.cancel()
+            raise UpstreamBusy(f'{self.host}: rate limit queue is full')
+        if delay > 0:
+            time.sleep(delay)
+        remaining = self.config.queue_timeout - (time.monotonic() - start)
+        if not self.concurrency.acquire(max(remaining, 0.0)):
+            raise UpstreamBusy(f'{self.host}: {self.concurrency.in_flight} requests in flight')
+        QUEUE_WAIT.observe(time.monotonic() - start, host=self.host)
+
+    async def acquire_async(self):
+        start = time.monotonic()
+        delay = self.bucket.reserve()
+        if delay > self.config.queue_timeout:
+            self.bucket.cancel()
+            raise UpstreamBusy(f'{self.host}: rate limit queue is full')
+        if delay > 0:
+            await asyncio.sleep(delay)
+        remaining = self.config.queue_timeout - (time.monotonic() - start)
+        if not await self.concurrency.acquire_async(max(remaining, 0.0)):
+            raise UpstreamBusy(f'{self.host}: {self.concurrency.in_flight} requests in flight')
+        QUEUE_WAIT.observe(time.monotonic() - start, host=self.host)
+
+    def release(self, error=None):
+        """归还并发名额；error 为上游异常时据此调整并发上限"""
+        overloaded = error is not None and is_overload(error)
+        if overloaded:
+            pause = retry_after(error)
+            if pause:
+                self.bucket.pause(pause)
+        limit = self.concurrency.release(overloaded=overloaded, succeeded=error is None)
+        CONCURRENCY_LIMIT.set(limit, host=self.host)
+
+    def backoff(self, error, attempt, max_retries=None):
+        """第 attempt 次重试前的等待秒数；不应重试时返回 None。max_retries 为 None 时使用配置值"""
+        if max_retries is None:
+            max_retries = self.config.max_retries
+        if attempt >= max_retries or not is_retryable(error):
+            return None
+        UPSTREAM_RETRIES.inc(host=self.host, reason=getattr(error, 'status_code', None) or type(error).__name__)
+        delay = retry_after(error)
+        if delay is not None:
+            # 按上游要求的时间等待，加少量抖动避免同时重试
+            return min(delay, self.config.backoff_max) + random.uniform(0, self.config.backoff_base)
+        # 全抖动指数退避
+        return random.uniform(0, min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt))
+
+    def stats(self):
+        return {
+            'concurrency_limit': self.concurrency.limit,
+            'in_flight': self.concurrency.in_flight,
+            'rate': self.bucket.rate,
+        }
+
+
+_lock = threading.Lock()
+_limiters = {}  # host -> UpstreamLimiter
+_processes = 1  # 分摊限速的进程数
+
+
+def split_across_processes(processes):
+    """多进程部署时在每个 worker 中调用：之后创建的限速器按 processes 分摊速率和并发上限
+
+    丢弃从主进程继承的限速器。AIMD 在各 worker 中独立调整，每个 worker 最多用到自己的份额。
+    """
+    global _processes
+    with _lock:
+        _processes = max(1, processes)
+        _limiters.clear()
+
+
+def get_limiter(host, config=None):
+    """获取某个上游地址共享的 UpstreamLimiter；config 只在第一次创建时生效"""
+    limiter = _limiters.get(host)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(host)
+            if limiter is None:
+                limiter = _limiters[host] = UpstreamLimiter(host, (config or LimitConfig()).split(_processes))
+    return limiter
+
+
+def limiter_stats():
+    with _lock:
+        items = list(_limiters.items())
+    return {host: limiter.stats() for host, limiter in items}
@@ -0,0 +1,188 @@
+"""按内容寻址的分析结果缓存：内存 LRU + 可选 SQLite 持久层"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_image(image):
+    """计算图片内容的 sha256，支持文件路径、bytes 和文件对象"""
+    digest = hashlib.sha256()
+    if isinstance(image, (bytes, bytearray)):
+        digest.update(image)
+        return digest.hexdigest()
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as image_file:
+            return hash_image(image_file)
+
+    # 文件对象：分块读取，读完后回到开头，方便后续编码
+    image.seek(0)
+    while True:
+        chunk = image.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    image.seek(0)
+    return digest.hexdigest()
+
+
+def make_key(image_digest, prompt, model_id, params=None):
+    """由图片哈希、提示词、模型和生成参数得到缓存键"""
+    payload = json.dumps(
+        [image_digest, prompt, model_id, params or {}],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """线程安全的结果缓存
+
+    内存层按字节预算做 LRU 淘汰；设置 db_path 后写入 SQLite，进程重启后仍可命中。
+    所有条目都有 TTL，过期后视为未命中。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600, db_path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._db = None
+        if db_path:
+            self._db = self._connect()
+
+    def _connect(self):
+        # 多个 worker 进程共用同一个数据库文件：WAL 允许读写并发，写冲突时最多等待 10 秒
+        db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        db.commit()
+        return db
+
+    def reopen(self):
+        """fork 出的子进程中调用：SQLite 连接不能跨进程使用，改用本进程自己的连接
+
+        内存层各进程独立（继承的条目仍然有效），进程间通过 SQLite 共享结果。
+        """
+        if self.db_path:
+            with self._lock:
+                self._db = self._connect()
+
+    @classmethod
+    def from_env(cls):
+        """根据环境变量创建缓存，RESULT_CACHE_MAX_BYTES=0 表示关闭内存层"""
+        return cls(
+            max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+            ttl=float(os.getenv('RESULT_CACHE_TTL', str(7 * 24 * 3600))),
+            db_path=os.getenv('RESULT_CACHE_DB') or None,
+        )
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self._db is not None
+
+    def get(self, key):
+        """返回缓存的结果，未命中返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                self.expirations += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, expires_at FROM results WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = row
+                    if expires_at > now:
+                        self.hits += 1
+                        self.disk_hits += 1
+                        self._store(key, value, expires_at)
+                        return value
+                    self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self._db.commit()
+                    self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """写入结果，内存层和磁盘层同时更新"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, value, expires_at),
+                )
+                self._db.commit()
+
+    def _store(self, key, value, expires_at):
+        size = len(key) + len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM results')
+                self._db.commit()
+
+    def stats(self):
+        """返回命中、未命中、淘汰等计数"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'persistent': self._db is not None,
+            }
+
+
+# 各入口共享的默认缓存
+result_cache = ResultCache.from_env()
@@ -0,0 +1,412 @@
+"""多后端路由：按延迟选择后端，超过 p95 时发送对冲请求，出错时自动切换
+
+每个入口（app.py 的图片描述、空间理解、界面定位）对应一个路由，后端列表可通过 QWEN_ROUTES 配置，
+值为 JSON 字符串或 JSON 文件路径，例如：
+
+    {
+      "describe": {
+        "backends": [
+          {"name": "modelscope", "base_url": "https://api-inference.modelscope.cn/v1/",
+           "model": "Qwen/Qwen2.5-VL-72B-Instruct", "api_key_env": "MODELSCOPE_API_KEY"},
+          {"name": "vllm", "base_url": "http://10.0.0.5:8000/v1", "model": "Qwen2.5-VL-7B-Instruct",
+           "api_key": "EMPTY"}
+        ],
+        "hedge": true
+      },
+      "grounding": [{"name": "dashscope", "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+                     "api_key_env": "DASHSCOPE_API_KEY"}]
+    }
+
+未配置的路由使用入口自带的默认后端（即原来写死的地址和模型）。后端没有指定 model 时沿用调用方传入的模型；
+chat_completion_with_model 同时返回应答后端使用的模型（按配置，不依赖上游回显的名称），
+入口据此记录用量，应答模型与请求不同时不写入结果缓存。
+"""
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import openai
+
+from metrics import Counter
+from qwen_client import create_chat_completion, create_chat_completion_async, get_client
+from rate_limit import UpstreamBusy
+
+ROUTER_REQUESTS = Counter('qwen_router_requests_total', 'Routed upstream calls by backend and outcome',
+                          ('route', 'backend', 'outcome'))
+ROUTER_FAILOVERS = Counter('qwen_router_failovers_total', 'Calls moved to another backend after an error',
+                           ('route', 'backend'))
+ROUTER_HEDGES = Counter('qwen_router_hedges_total', 'Duplicate requests sent after the hedge deadline',
+                        ('route',))
+ROUTER_HEDGE_WINS = Counter('qwen_router_hedge_wins_total', 'Hedged requests that answered first',
+                            ('route',))
+
+# 对冲请求在线程池里执行，调用方线程只负责等待
+HEDGE_WORKERS = int(os.getenv('QWEN_HEDGE_WORKERS', '32'))
+_hedge_executor = None
+_executor_lock = threading.Lock()
+
+
+def _executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+    return _hedge_executor
+
+
+@dataclass
+class Backend:
+    """一个 OpenAI 兼容的后端"""
+    name: str
+    base_url: str
+    model: str = None  # None 表示沿用调用方的模型
+    api_key: str = None
+    api_key_env: str = None
+
+    def resolved_api_key(self):
+        if self.api_key is not None:
+            return self.api_key
+        return os.getenv(self.api_key_env) if self.api_key_env else None
+
+
+class BackendState:
+    """单个后端的延迟 EWMA、近期延迟样本、在途请求数和熔断状态
+
+    非流式请求的延迟是完整响应的耗时，流式请求只到拿到响应头为止，两者差一个生成时间，
+    分别统计：ewma/samples 为非流式，stream_ewma/stream_samples 为流式。
+    """
+
+    def __init__(self, backend, alpha=0.3, window=200):
+        self.backend = backend
+        self.alpha = alpha
+        self.ewma = None
+        self.samples = deque(maxlen=window)
+        self.stream_ewma = None
+        self.stream_samples = deque(maxlen=window)
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def success(self, latency, stream=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.successes += 1
+            self.consecutive_failures = 0
+            if stream:
+                self.stream_samples.append(latency)
+                self.stream_ewma = self._smooth(self.stream_ewma, latency)
+            else:
+                self.samples.append(latency)
+                self.ewma = self._smooth(self.ewma, latency)
+
+    def _smooth(self, ewma, latency):
+        return latency if ewma is None else self.alpha * latency + (1 - self.alpha) * ewma
+
+    def latency(self, stream=False):
+        """对应模式的延迟 EWMA，没有样本时为 None"""
+        return self.stream_ewma if stream else self.ewma
+
+    def failure(self, threshold, cooldown):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= threshold:
+                # 连续失败后暂时排到最后，冷却结束再参与正常排序
+                self.open_until = time.monotonic() + cooldown
+
+    def cancelled(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @property
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def quantile(self, q, stream=False):
+        with self._lock:
+            samples = sorted(self.stream_samples if stream else self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(math.ceil(q * len(samples))) - 1)]
+
+    def snapshot(self):
+        return {
+            'base_url': self.backend.base_url,
+            'model': self.backend.model,
+            'ewma_latency': self.ewma,
+            'p95_latency': self.quantile(0.95),
+            'stream_ewma_latency': self.stream_ewma,
+            'stream_p95_latency': self.quantile(0.95, stream=True),
+            'in_flight': self.in_flight,
+            'successes': self.successes,
+            'failures': self.failures,
+            'open': self.is_open,
+        }
+
+
+def should_failover(error):
+    # 上游返回的任何错误以及本地排队超时都换一个后端再试；代码自身的异常直接抛出
+    return isinstance(error, (openai.APIError, UpstreamBusy))
+
+
+class Router:
+    """在一组后端之间做延迟感知的负载均衡、对冲和故障转移"""
+
+    def __init__(self, name, backends, hedge=False, hedge_quantile=0.95, hedge_min_samples=20,
+                 hedge_delay=None, failure_threshold=3, cooldown=30.0):
+        if not backends:
+            raise ValueError(f'route {name!r} has no backends')
+        self.name = name
+        self.states = [BackendState(backend) for backend in backends]
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_delay = hedge_delay  # 样本不足时使用的固定对冲等待时间，None 表示样本不足时不对冲
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    def ranked(self, stream=False):
+        """按预期等待时间排序：熔断中的排最后，其次是同一模式（流式 / 非流式）的 EWMA 延迟 ×（在途请求数 + 1）"""
+        known = [state.latency(stream) for state in self.states if state.latency(stream) is not None]
+        # 还没有样本的后端按已知最快的延迟估计，保证它会被尝试
+        prior = min(known) if known else 0.0
+
+        def score(item):
+            index, state = item
+            ewma = state.latency(stream) if state.latency(stream) is not None else prior
+            return (state.is_open, ewma * (state.in_flight + 1), state.in_flight, index)
+
+        return [state for _, state in sorted(enumerate(self.states), key=score)]
+
+    def hedge_deadline(self, state):
+        if not self.hedge or len(self.states) < 2:
+            return None
+        if len(state.samples) >= self.hedge_min_samples:
+            return state.quantile(self.hedge_quantile)
+        return self.hedge_delay
+
+    @staticmethod
+    def _model(state, kwargs):
+        return state.backend.model or kwargs.get('model')
+
+    def _request(self, state, kwargs, max_retries):
+        backend = state.backend
+        request = dict(kwargs)
+        if backend.model:
+            request['model'] = backend.model
+        return dict(api_key=backend.resolved_api_key(), max_retries=max_retries, **request)
+
+    def _record(self, state, started, error=None, stream=False):
+        if error is None:
+            state.success(time.perf_counter() - started, stream)
+            ROUTER_REQUESTS.inc(route=self.name, backend=state.backend.name, outcome='ok')
+        else:
+            state.failure(self.failure_threshold, self.cooldown)
+            ROUTER_REQUESTS.inc(route=self.name, backend=state.backend.name, outcome='error')
+
+    def _call(self, state, kwargs, max_retries):
+        # 流式请求以拿到响应头为准记录延迟，之后的读取不再计入；与非流式的延迟分开统计
+        stream = bool(kwargs.get('stream'))
+        state.start()
+        started = time.perf_counter()
+        try:
+            response = create_chat_completion(state.backend.base_url, **self._request(state, kwargs, max_retries))
+        except Exception as e:
+            self._record(state, started, e)
+            raise
+        self._record(state, started, stream=stream)
+        return response, self._model(state, kwargs)
+
+    async def _call_async(self, state, kwargs, max_retries):
+        stream = bool(kwargs.get('stream'))
+        state.start()
+        started = time.perf_counter()
+        try:
+            response = await create_chat_completion_async(
+                state.backend.base_url, **self._request(state, kwargs, max_retries),
+            )
+        except asyncio.CancelledError:
+            # 对冲中落败的请求被取消，不算后端的错误
+            state.cancelled()
+            raise
+        except Exception as e:
+            self._record(state, started, e)
+            raise
+        self._record(state, started, stream=stream)
+        return response, self._model(state, kwargs)
+
+    def chat_completion(self, **kwargs):
+        """按路由调用 chat.completions.create；流式请求只做故障转移，不做对冲"""
+        return self.chat_completion_with_model(**kwargs)[0]
+
+    def chat_completion_with_model(self, **kwargs):
+        """同 chat_completion，返回 (响应, 模型)：模型为应答后端配置的 model，没有配置时为请求的模型"""
+        candidates = self.ranked(bool(kwargs.get('stream')))
+        deadline = None if kwargs.get('stream') else self.hedge_deadline(candidates[0])
+        if deadline is None:
+            return self._failover(candidates, kwargs)
+        return self._hedged(candidates, kwargs, deadline)
+
+    def _failover(self, candidates, kwargs):
+        for index, state in enumerate(candidates):
+            last = index == len(candidates) - 1
+            try:
+                # 还有后端可换时不在原地重试，出错立即切换；最后一个后端按正常策略重试
+                return self._call(state, kwargs, None if last else 0)
+            except Exception as e:
+                if last or not should_failover(e):
+                    raise
+                ROUTER_FAILOVERS.inc(route=self.name, backend=state.backend.name)
+
+    def _hedged(self, candidates, kwargs, deadline):
+        remaining = list(candidates)
+        pending = {}
+        last_error = None
+
+        def launch():
+            state = remaining.pop(0)
+            future = _executor().submit(self._call, state, kwargs, 0 if remaining else None)
+            pending[future] = state
+
+        launch()
+        primary = candidates[0]
+        timeout = deadline
+        while pending:
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 超过 p95 仍未返回：向下一个后端发送相同请求，先到者胜出
+                if remaining:
+                    ROUTER_HEDGES.inc(route=self.name)
+                    launch()
+                timeout = None
+                continue
+            for future in done:
+                state = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not should_failover(e):
+                        raise
+                    last_error = e
+                    ROUTER_FAILOVERS.inc(route=self.name, backend=state.backend.name)
+                    if remaining:
+                        launch()
+                    continue
+                # 落败的同步请求无法中途取消，在后台完成后被丢弃
+                if state is not primary:
+                    ROUTER_HEDGE_WINS.inc(route=self.name)
+                return result
+        raise last_error
+
+    async def chat_completion_async(self, **kwargs):
+        """chat_completion 的异步版本；对冲中落败的请求会被取消"""
+        return (await self.chat_completion_with_model_async(**kwargs))[0]
+
+    async def chat_completion_with_model_async(self, **kwargs):
+        """chat_completion_with_model 的异步版本"""
+        candidates = self.ranked(bool(kwargs.get('stream')))
+        deadline = None if kwargs.get('stream') else self.hedge_deadline(candidates[0])
+        remaining = list(candidates)
+        pending = {}
+        last_error = None
+
+        def launch():
+            state = remaining.pop(0)
+            task = asyncio.ensure_future(self._call_async(state, kwargs, 0 if remaining else None))
+            pending[task] = state
+
+        launch()
+        primary = candidates[0]
+        timeout = deadline
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if remaining:
+                        ROUTER_HEDGES.inc(route=self.name)
+                        launch()
+                    timeout = None
+                    continue
+                for task in done:
+                    state = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if state is not primary:
+                            ROUTER_HEDGE_WINS.inc(route=self.name)
+                        return task.result()
+                    if not should_failover(error):
+                        raise error
+                    last_error = error
+                    ROUTER_FAILOVERS.inc(route=self.name, backend=state.backend.name)
+                    if remaining:
+                        launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def warm_up(self):
+        """提前创建各后端的共享客户端和连接池，第一个请求不必承担初始化开销"""
+        for state in self.states:
+            get_client(state.backend.base_url, state.backend.resolved_api_key())
+
+    def stats(self):
+        return {state.backend.name: state.snapshot() for state in self.states}
+
+
+def load_routes():
+    """读取 QWEN_ROUTES（JSON 字符串或文件路径），返回 {路由名: 配置}"""
+    value = os.getenv('QWEN_ROUTES', '').strip()
+    if not value:
+        return {}
+    if not value.startswith('{'):
+        with open(value, encoding='utf-8') as f:
+            value = f.read()
+    return json.loads(value)
+
+
+_lock = threading.Lock()
+_routers = {}  # 路由名 -> Router
+
+
+def get_router(name, default_backends):
+    """获取某个入口共享的 Router；QWEN_ROUTES 中没有该路由时使用 default_backends"""
+    router = _routers.get(name)
+    if router is not None:
+        return router
+    with _lock:
+        router = _routers.get(name)
+        if router is None:
+            config = load_routes().get(name)
+            if config is None:
+                router = Router(name, default_backends)
+            else:
+                if isinstance(config, list):
+                    config = {'backends': config}
+                config = dict(config)
+                backends = [Backend(**backend) for backend in config.pop('backends')]
+                router = Router(name, backends, **config)
+            _routers[name] = router
+    return router
+
+
+def router_stats():
+    """返回各路由下每个后端的延迟、在途请求和熔断状态"""
+    with _lock:
+        items = list(_routers.items())
+    return {name: router.stats() for name, router in items}
@@ -0,0 +1,194 @@
+"""多进程部署 app.py：主进程监听端口后预先 fork 出多个 worker，每个 worker 是一个多线程 WSGI 服务
+
+    python serve.py --workers 4 --bind 0.0.0.0:5000
+
+与 app.run(debug=True) 的开发服务器相比，请求解析、图片缩放和 base64 编码可以分摊到多个 CPU 核。
+app 在主进程中导入一次（导入错误在 fork 前暴露，模块内存写时复制共享），每个 worker 启动后
+各自建立连接池并预热编解码器。各 worker 通过 SQLite 共用结果缓存（--cache-db，默认
+result_cache.sqlite3），/metrics 导出所有 worker 的合计。收到 SIGTERM 或 Ctrl-C 时停止接受新连接，
+等待在途请求（包括流式响应）完成后退出，超过 --graceful-timeout 秒强制结束；worker 异常退出时自动补上。
+只依赖 Flask 自带的 werkzeug，不需要 gunicorn。
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+
+class InFlight:
+    """WSGI 中间件：统计在途请求；流式响应在迭代结束、close() 之后才算完成"""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._cond:
+            self.count += 1
+        try:
+            iterable = self.app(environ, start_response)
+        except BaseException:
+            self._finish()
+            raise
+        return ClosingIterator(iterable, self._finish)
+
+    def _finish(self):
+        with self._cond:
+            self.count -= 1
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout):
+        """等待在途请求全部完成，超时返回 False"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+def log(message):
+    print(f'[serve {os.getpid()}] {message}', file=sys.stderr, flush=True)
+
+
+def run_worker(listener, host, args):
+    """worker 进程：重建 fork 前不能共享的资源，预热后处理请求，直到收到 SIGTERM"""
+    # Ctrl-C 会发给整个进程组，由主进程统一转为 SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import app as application
+    import metrics
+    import rate_limit
+    from qwen_client import close_clients
+    from result_cache import result_cache
+    from usage import usage_tracker
+
+    result_cache.reopen()
+    metrics.enable_multiprocess(args.metrics_dir)
+    # 调用方预算存入共用的 SQLite，按所有 worker 合计；上游限速按 worker 数分摊
+    usage_tracker.share_windows(args.cache_db)
+    rate_limit.split_across_processes(args.workers)
+    application.warm_up()
+
+    wsgi = InFlight(application.app)
+    server = make_server(host, 0, wsgi, threaded=True, fd=listener.fileno())
+    stopping = threading.Event()
+
+    def on_term(signum, frame):
+        # shutdown() 会等待 serve_forever 退出，不能在同一线程（信号处理函数）里调用
+        if not stopping.is_set():
+            stopping.set()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_term)
+    log('worker ready')
+    server.serve_forever()
+    server.server_close()
+
+    drained = wsgi.wait_idle(args.graceful_timeout)
+    if not drained:
+        log(f'{wsgi.count} requests still running after {args.graceful_timeout}s, exiting anyway')
+    metrics.write_snapshot()
+    close_clients()
+    os._exit(0 if drained else 1)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default='127.0.0.1:5000', help='监听地址 host:port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker 进程数，默认 CPU 核数')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--graceful-timeout', type=float, default=60.0, help='退出时等待在途请求的最长秒数')
+    parser.add_argument('--cache-db', default=os.getenv('RESULT_CACHE_DB') or 'result_cache.sqlite3',
+                        help='worker 共用的 SQLite 结果缓存')
+    parser.add_argument('--metrics-dir', default=os.getenv('METRICS_MULTIPROC_DIR'),
+                        help='worker 写入指标的目录，默认使用临时目录')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    host, _, port = args.bind.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+
+    # 在导入 app 之前设置，result_cache 按环境变量打开 SQLite
+    os.environ['RESULT_CACHE_DB'] = args.cache_db
+    if args.metrics_dir:
+        shutil.rmtree(args.metrics_dir, ignore_errors=True)
+        os.makedirs(args.metrics_dir)
+    else:
+        args.metrics_dir = tempfile.mkdtemp(prefix='qwen-metrics-')
+
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    listener = socket.create_server((host, int(port)), family=family, backlog=args.backlog)
+    listener.set_inheritable(True)
+
+    import app  # noqa: F401  预加载，worker 继承已导入的模块
+
+    workers = {}  # pid -> 启动时间
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listener, host, args)
+            finally:
+                os._exit(1)
+        workers[pid] = time.monotonic()
+
+    stopping = []
+
+    def on_signal(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    for _ in range(args.workers):
+        spawn()
+    log(f'listening on {args.bind} with {args.workers} workers')
+
+    while not stopping:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        started = workers.pop(pid, None)
+        if started is None:
+            continue
+        log(f'worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting')
+        if time.monotonic() - started < 1.0:
+            # 启动即崩溃时放慢重启，避免空转
+            time.sleep(1.0)
+        if not stopping:
+            spawn()
+
+    log('shutting down, draining in-flight requests')
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + args.graceful_timeout + 5
+    while workers and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            workers.pop(pid, None)
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+    listener.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,27 @@
 import json
-import base64
+import math
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from PIL import ImageColor
-from openai import OpenAI
+from qwen_client import DASHSCOPE_BASE_URL
+from router import Backend, get_router
+from result_cache import hash_image, make_key, result_cache
+from image_preprocess import IMAGE_FORMAT, IMAGE_QUALITY, prepare_image
+from profiling import stage
+from usage import usage_tracker
 
-def encode_image(image_path):
-    """将图片转换为 base64 编码"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+# 空间理解路由：默认使用百炼，可通过 QWEN_ROUTES 的 "spatial" 配置多个后端
+spatial_router = get_router("spatial", [Backend("dashscope", DASHSCOPE_BASE_URL)])
+
+def encode_image(image_path, min_pixels=512*28*28, max_pixels=2048*28*28):
+    """按 smart_resize 的目标尺寸缩放后编码为 data URL"""
+    with stage("preprocess"):
+        image = Image.open(image_path)
+        input_height, input_width = smart_resize(image.height, image.width, min_pixels, max_pixels)
+        return prepare_image(image_path, target_size=(input_width, input_height)).data_url
 
 def smart_resize(height, width, min_pixels=512*28*28, max_pixels=2048*28*28):
     """智能调整图片尺寸"""
@@ -20,14 +34,21 @@ def smart_resize(height, width, min_pixels=512*28*28, max_pixels=2048*28*28):
         return int(height * scale), int(width * scale)
     return height, width
 
-def inference_with_api(image_path, prompt, sys_prompt="您是一位助手。", model_id="qwen2.5-vl-72b-instruct", min_pixels=512*28*28, max_pixels=2048*28*28):
-    """使用 API 进行推理"""
-    base64_image = encode_image(image_path)
-    client = OpenAI(
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+def _cache_key(image_path, prompt, sys_prompt, model_id, min_pixels, max_pixels):
+    """结果缓存键，缓存关闭时返回 None"""
+    if not result_cache.enabled:
+        return None
+    with stage("hash"):
+        digest = hash_image(image_path)
+    return make_key(digest, prompt, model_id, {
+        "sys_prompt": sys_prompt, "min_pixels": min_pixels, "max_pixels": max_pixels,
+        "format": IMAGE_FORMAT, "quality": IMAGE_QUALITY,
+    })
 
-    messages = [
+def build_messages(image_path, prompt, sys_prompt, min_pixels, max_pixels):
+    """构造请求消息"""
+    image_url = encode_image(image_path, min_pixels, max_pixels)
+    return [
         {
             "role": "system",
             "content": [{"type": "text", "text": sys_prompt}]
@@ -39,21 +60,180 @@ def inference_with_api(image_path, prompt, sys_prompt="您是一位助手。", m
                     "type": "image_url",
                     "min_pixels": min_pixels,
                     "max_pixels": max_pixels,
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                    "image_url": {"url": image_url},
                 },
                 {"type": "text", "text": prompt},
             ],
         }
     ]
-    
-    completion = client.chat.completions.create(
-        model=model_id,
-        messages=messages,
-    )
-    return completion.choices[0].message.content
+
+def plan_request(width, height, min_pixels, max_pixels, client=None):
+    """按用量预算确定本次请求的 max_pixels（可能调低，预算不足时抛出 BudgetExceeded）
+
+    返回的 plan.width/plan.height 是模型实际看到的输入尺寸，模型输出的坐标以它为准。
+    预算调低 max_pixels 后输入尺寸会变小，需要换算坐标的调用方应先调用本函数，
+    把 plan 传给 inference_with_api / inference_with_api_stream，并用 plan 的尺寸绘制边界框。
+    """
+    return usage_tracker.plan("spatial", width, height, min_pixels, max_pixels, smart_resize, client)
+
+def _plan_for(image_path, min_pixels, max_pixels, client):
+    with Image.open(image_path) as image:
+        return plan_request(image.width, image.height, min_pixels, max_pixels, client)
+
+def inference_with_api(image_path, prompt, sys_prompt="您是一位助手。", model_id="qwen2.5-vl-72b-instruct", min_pixels=512*28*28, max_pixels=2048*28*28, client=None, plan=None):
+    """使用 API 进行推理；plan 为 plan_request 的结果，不传时按预算重新确定"""
+    started = time.perf_counter()
+    if plan is None:
+        plan = _plan_for(image_path, min_pixels, max_pixels, client)
+    max_pixels = plan.max_pixels
+    try:
+        # 相同图片、提示词和参数直接返回缓存结果
+        key = _cache_key(image_path, prompt, sys_prompt, model_id, min_pixels, max_pixels)
+        if key is not None:
+            cached = result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        completion, model = spatial_router.chat_completion_with_model(
+            model=model_id,
+            messages=build_messages(image_path, prompt, sys_prompt, min_pixels, max_pixels),
+        )
+        usage_tracker.record("spatial", model, completion.usage, time.perf_counter() - started, plan, client)
+    finally:
+        # 命中缓存或调用失败时退还预留的 token
+        usage_tracker.release(plan)
+    result = completion.choices[0].message.content
+    # 缓存键按请求的模型计算，路由到其他模型的后端时不写入
+    if key is not None and model == model_id:
+        result_cache.set(key, result)
+    return result
+
+def inference_with_api_stream(image_path, prompt, sys_prompt="您是一位助手。", model_id="qwen2.5-vl-72b-instruct", min_pixels=512*28*28, max_pixels=2048*28*28, client=None, plan=None):
+    """流式推理，逐段产出模型输出的文本；plan 同 inference_with_api"""
+    started = time.perf_counter()
+    if plan is None:
+        plan = _plan_for(image_path, min_pixels, max_pixels, client)
+    max_pixels = plan.max_pixels
+    try:
+        key = _cache_key(image_path, prompt, sys_prompt, model_id, min_pixels, max_pixels)
+        cached = result_cache.get(key) if key is not None else None
+        if cached is None:
+            stream, model = spatial_router.chat_completion_with_model(
+                model=model_id,
+                messages=build_messages(image_path, prompt, sys_prompt, min_pixels, max_pixels),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+    except BaseException:
+        usage_tracker.release(plan)
+        raise
+    if cached is not None:
+        usage_tracker.release(plan)
+        yield cached
+        return
+
+    parts = []
+    usage = None
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield parts[-1]
+            if chunk.usage:
+                usage = chunk.usage
+    finally:
+        stream.close()
+        usage_tracker.record("spatial", model, usage, time.perf_counter() - started, plan, client)
+    if key is not None and model == model_id:
+        result_cache.set(key, "".join(parts))
+
+class BoundingBoxStreamParser:
+    """增量解析模型输出中的边界框对象
+
+    每次 feed 只扫描新到的文本：对象外的内容（markdown 代码块标记、数组括号、逗号等）直接跳过，
+    对象内只缓存当前对象的文本。某个对象的右花括号一到，就解析并返回含 bbox_2d/bbox 的对象。
+    输出被截断时，未闭合的最后一个对象被丢弃，之前的对象不受影响。
+    """
+
+    _INSIDE = re.compile(r'[{}"]')
+    _IN_STRING = re.compile(r'["\\]')
+
+    def __init__(self):
+        self._buffer = ""
+        self._starts = []  # 当前未闭合对象在 _buffer 中的起始位置
+        self._in_string = False
+        self._escape = False
+        self.skipped = 0  # 闭合但无法解析的对象数
+
+    def feed(self, chunk):
+        """输入一段新文本，返回其中新完成的边界框对象列表"""
+        boxes = []
+        pos = 0
+        while pos < len(chunk):
+            if not self._starts:
+                start = chunk.find("{", pos)
+                if start < 0:
+                    break
+                self._buffer = "{"
+                self._starts.append(0)
+                pos = start + 1
+                continue
+
+            if self._escape:
+                self._buffer += chunk[pos]
+                self._escape = False
+                pos += 1
+                continue
+
+            pattern = self._IN_STRING if self._in_string else self._INSIDE
+            match = pattern.search(chunk, pos)
+            if match is None:
+                self._buffer += chunk[pos:]
+                break
+            self._buffer += chunk[pos:match.end()]
+            pos = match.end()
+            char = match.group()
+
+            if self._in_string:
+                if char == "\\":
+                    self._escape = True
+                else:
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._starts.append(len(self._buffer) - 1)
+            else:
+                start = self._starts.pop()
+                box = self._parse(self._buffer[start:])
+                if box is not None:
+                    boxes.append(box)
+                if not self._starts:
+                    self._buffer = ""
+        return boxes
+
+    def _parse(self, text):
+        try:
+            obj = json.loads(text)
+        except json.JSONDecodeError:
+            self.skipped += 1
+            return None
+        if isinstance(obj, dict) and ("bbox_2d" in obj or "bbox" in obj):
+            return obj
+        return None
+
+def iter_bounding_boxes(chunks):
+    """从文本片段流中逐个产出边界框对象"""
+    parser = BoundingBoxStreamParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
 
 def extract_json_from_text(text):
     """从文本中提取 JSON 内容"""
+    with stage("parse"):
+        return _extract_json_from_text(text)
+
+def _extract_json_from_text(text):
     # 尝试多种格式的 JSON 提取
     if "```json" in text:
         # 提取 markdown 代码块中的 JSON
@@ -68,72 +248,292 @@ def extract_json_from_text(text):
         # 尝试直接解析
         return json.loads(json_str)
     except json.JSONDecodeError:
-        # 如果解析失败，尝试清理和修复 JSON 字符串
-        import re
-        # 移除换行符和多余的空白字符
-        cleaned_text = re.sub(r'[\n\r\t\s]+', ' ', json_str)
-        # 确保是一个数组格式
-        if not cleaned_text.startswith('['):
-            cleaned_text = f"[{cleaned_text}"
-        if not cleaned_text.endswith(']'):
-            cleaned_text = f"{cleaned_text}]"
-        return json.loads(cleaned_text)
-
-def plot_bounding_boxes(image, bounding_boxes, input_width, input_height):
-    """绘制边界框"""
+        # 解析失败（缺少数组括号、输出被截断导致代码块未闭合等）时，
+        # 从原文中取出所有完整的边界框对象
+        boxes = BoundingBoxStreamParser().feed(text)
+        if not boxes:
+            raise
+        return boxes
+
+COLORS = ['red', 'green', 'blue', 'yellow', 'orange', 'pink', 'purple', 
+          'brown', 'gray', 'beige', 'turquoise', 'cyan', 'magenta']
+
+def boxes_to_array(boxes):
+    """把边界框对象列表转为 (N, 4) 的 float 数组
+
+    返回 (坐标数组, 标签列表, 原始下标数组)；缺少坐标、坐标个数不为 4 或无法转为数字的对象被丢弃。
+    """
+    rows, labels, indices = [], [], []
+    for i, box in enumerate(boxes):
+        if not isinstance(box, dict):
+            continue
+        bbox = box.get("bbox_2d", box.get("bbox"))
+        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+            rows.append(bbox)
+            labels.append(box.get("label"))
+            indices.append(i)
+    try:
+        coords = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    except (TypeError, ValueError):
+        # 个别坐标不是数字时逐行转换，只丢弃出错的行
+        coords, kept = [], []
+        for k, row in enumerate(rows):
+            try:
+                coords.append(np.array(row, dtype=np.float64))
+                kept.append(k)
+            except (TypeError, ValueError):
+                continue
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 4)
+        labels = [labels[k] for k in kept]
+        indices = [indices[k] for k in kept]
+    return coords, labels, np.array(indices, dtype=np.intp)
+
+def scale_boxes(coords, input_width, input_height, width, height):
+    """把模型输入尺寸下的坐标一次性换算到原图，并保证 x1<=x2、y1<=y2
+
+    返回 (整数坐标数组, 有效行掩码)；非有限值和面积为 0 的框记为无效。
+    """
+    # 先归一化再乘原图尺寸，与逐个换算时的浮点结果完全一致
+    scaled = coords / np.array([input_width, input_height] * 2) * np.array([width, height] * 2)
+    valid = np.isfinite(scaled).all(axis=1)
+    # 截断取整，与 int() 的结果一致
+    scaled = np.trunc(np.where(valid[:, None], scaled, 0)).astype(np.int64)
+    x1 = np.minimum(scaled[:, 0], scaled[:, 2])
+    x2 = np.maximum(scaled[:, 0], scaled[:, 2])
+    y1 = np.minimum(scaled[:, 1], scaled[:, 3])
+    y2 = np.maximum(scaled[:, 1], scaled[:, 3])
+    valid &= (x2 > x1) & (y2 > y1)
+    return np.stack([x1, y1, x2, y2], axis=1), valid
+
+def draw_bounding_box(draw, box, color, input_width, input_height, width, height, font):
+    """把模型坐标系下的一个边界框画到原图上，格式不正确时返回 False"""
+    coords, labels, _ = boxes_to_array([box])
+    scaled, valid = scale_boxes(coords, input_width, input_height, width, height)
+    if not valid.any():
+        return False
+    x1, y1, x2, y2 = scaled[0].tolist()
+    draw.rectangle(((x1, y1), (x2, y2)), outline=color, width=4)
+    if labels[0] is not None:
+        draw.text((x1 + 8, y1 + 6), str(labels[0]), fill=color, font=font)
+    return True
+
+def plot_bounding_boxes(image, bounding_boxes, input_width, input_height, verbose=False):
+    """绘制边界框
+
+    bounding_boxes 可以是模型输出的文本，也可以是已解析的边界框列表。
+    坐标换算和过滤一次性在 NumPy 中完成，循环里只剩绘制调用；verbose=True 时打印调试信息。
+    """
     width, height = image.size
-    draw = ImageDraw.Draw(image)
     
-    colors = ['red', 'green', 'blue', 'yellow', 'orange', 'pink', 'purple', 
-              'brown', 'gray', 'beige', 'turquoise', 'cyan', 'magenta']
+    if verbose:
+        # 打印 API 返回内容以便调试
+        print("API 返回内容：")
+        print(bounding_boxes)
     
-    # 打印 API 返回内容以便调试
-    print("API 返回内容：")
-    print(bounding_boxes)
+    if isinstance(bounding_boxes, str):
+        try:
+            # 使用提取函数获取 JSON 数据
+            json_output = extract_json_from_text(bounding_boxes)
+        except Exception as e:
+            print(f"JSON 解析错误：{e}")
+            return image
+    else:
+        json_output = bounding_boxes
+    if isinstance(json_output, dict):
+        json_output = [json_output]
     
-    try:
-        # 使用提取函数获取 JSON 数据
-        json_output = extract_json_from_text(bounding_boxes)
+    coords, labels, indices = boxes_to_array(json_output)
+    scaled, valid = scale_boxes(coords, input_width, input_height, width, height)
+    if verbose:
         print("解析后的 JSON：")
         print(json_output)
-    except Exception as e:
-        print(f"JSON 解析错误：{e}")
-        return image
+        skipped = len(json_output) - int(valid.sum())
+        if skipped:
+            print(f"警告：{skipped} 个边界框数据格式不正确或面积为 0，已跳过")
     
+    draw = ImageDraw.Draw(image)
     font = ImageFont.load_default()
-    
-    for i, box in enumerate(json_output):
-        color = colors[i % len(colors)]
-        
-        try:
-            # 转换坐标，添加错误处理
-            bbox = box.get("bbox_2d", box.get("bbox", []))
-            if not bbox or len(bbox) != 4:
-                print(f"警告：第 {i+1} 个边界框数据格式不正确")
-                continue
-                
-            abs_y1 = int(float(bbox[1])/input_height * height)
-            abs_x1 = int(float(bbox[0])/input_width * width)
-            abs_y2 = int(float(bbox[3])/input_height * height)
-            abs_x2 = int(float(bbox[2])/input_width * width)
-            
-            if abs_x1 > abs_x2:
-                abs_x1, abs_x2 = abs_x2, abs_x1
-            if abs_y1 > abs_y2:
-                abs_y1, abs_y2 = abs_y2, abs_y1
-                
-            # 绘制边界框
-            draw.rectangle(((abs_x1, abs_y1), (abs_x2, abs_y2)), outline=color, width=4)
-            
-            # 绘制标签
-            if "label" in box:
-                draw.text((abs_x1 + 8, abs_y1 + 6), box["label"], fill=color, font=font)
-        except Exception as e:
-            print(f"处理第 {i+1} 个边界框时出错：{e}")
-            continue
+    # 颜色按原始下标分配，跳过无效框不会改变其他框的颜色
+    for (x1, y1, x2, y2), label, i in zip(scaled[valid].tolist(),
+                                         [labels[k] for k in np.flatnonzero(valid)],
+                                         indices[valid].tolist()):
+        color = COLORS[i % len(COLORS)]
+        # 绘制边界框
+        draw.rectangle(((x1, y1), (x2, y2)), outline=color, width=4)
+        # 绘制标签
+        if label is not None:
+            draw.text((x1 + 8, y1 + 6), str(label), fill=color, font=font)
     
     return image
 
+def tile_grid(width, height, tile_size, overlap=0.2):
+    """把图片划分为相互重叠的切片，返回 [(left, top, right, bottom)]
+
+    每个方向按 tile_size × (1 - overlap) 的步长均匀排布，最后一片与图片边缘对齐；
+    图片在某个方向上不超过 tile_size 时，该方向只有一片。
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        count = math.ceil((length - tile_size) / (tile_size * (1 - overlap))) + 1
+        return np.linspace(0, length - tile_size, count).round().astype(int).tolist()
+
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in starts(height) for left in starts(width)]
+
+def truncation_candidates(coords, tile_index, tiles, width, height, margin=4):
+    """可能是被切片截断的半个目标或重叠区重复检测的框，返回布尔数组
+
+    框的某条边离所在切片的内部边界（不是原图边缘）不超过 margin 像素，或框与其他切片有交集时为 True。
+    tile_index 为每个框来自的切片在 tiles 中的下标。
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=bool)
+    tiles = np.asarray(tiles, dtype=np.float64)
+    x1, y1, x2, y2 = coords.T
+    left, top, right, bottom = tiles[tile_index].T
+    clipped = (
+        ((x1 - left <= margin) & (left > 0)) | ((y1 - top <= margin) & (top > 0))
+        | ((right - x2 <= margin) & (right < width)) | ((bottom - y2 <= margin) & (bottom < height))
+    )
+    # 与每个切片的交集；框所在的切片总会相交，再有一个即位于重叠区
+    w = np.minimum(x2[:, None], tiles[None, :, 2]) - np.maximum(x1[:, None], tiles[None, :, 0])
+    h = np.minimum(y2[:, None], tiles[None, :, 3]) - np.maximum(y1[:, None], tiles[None, :, 1])
+    overlapping = ((w > 0) & (h > 0)).sum(axis=1) > 1
+    return clipped | overlapping
+
+def nms(coords, iou_threshold=0.5, containment_threshold=0.8, partial=None):
+    """不依赖置信度的 NMS，返回保留的行下标
+
+    模型不输出置信度，按面积从大到小保留：与已保留框的 IoU 超过 iou_threshold 的框被去除。
+    partial 为 truncation_candidates 的结果时，其中为 True 的框大部分面积（超过 containment_threshold）
+    落在已保留框内也被去除，用于去掉被切片边缘截断的半个目标，完整的框来自相邻切片的重叠区；
+    其余框只按 IoU 判断，挨在大船旁边的独立小船不会被当作重复框。
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.intp)
+    x1, y1, x2, y2 = coords.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-areas, kind="stable")
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        # 当前框与剩余所有框的交集一次算完
+        w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter)
+        suppressed = iou > iou_threshold
+        if partial is not None:
+            suppressed |= partial[rest] & (inter / areas[rest] > containment_threshold)
+        order = rest[~suppressed]
+    return np.array(keep, dtype=np.intp)
+
+def _infer_tile(image, tile, digest, prompt, sys_prompt, model_id, min_pixels, max_pixels, client=None):
+    """对一个切片调用模型，返回 (原图坐标数组, 标签列表)"""
+    started = time.perf_counter()
+    left, top, right, bottom = tile
+    tile_width, tile_height = right - left, bottom - top
+    plan = plan_request(tile_width, tile_height, min_pixels, max_pixels, client)
+    max_pixels = plan.max_pixels
+    input_height, input_width = plan.height, plan.width
+
+    try:
+        key = None
+        result = None
+        if digest is not None:
+            key = make_key(digest, prompt, model_id, {
+                "sys_prompt": sys_prompt, "min_pixels": min_pixels, "max_pixels": max_pixels,
+                "format": IMAGE_FORMAT, "quality": IMAGE_QUALITY, "tile": list(tile),
+            })
+            result = result_cache.get(key)
+
+        if result is None:
+            image_url = prepare_image(image.crop(tile), target_size=(input_width, input_height)).data_url
+            completion, model = spatial_router.chat_completion_with_model(
+                model=model_id,
+                messages=[
+                    {"role": "system", "content": [{"type": "text", "text": sys_prompt}]},
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "min_pixels": min_pixels,
+                                "max_pixels": max_pixels,
+                                "image_url": {"url": image_url},
+                            },
+                            {"type": "text", "text": prompt},
+                        ],
+                    },
+                ],
+            )
+            usage_tracker.record("spatial", model, completion.usage, time.perf_counter() - started, plan, client)
+            result = completion.choices[0].message.content
+            if key is not None and model == model_id:
+                result_cache.set(key, result)
+    finally:
+        usage_tracker.release(plan)
+
+    try:
+        boxes = extract_json_from_text(result)
+    except json.JSONDecodeError:
+        return np.zeros((0, 4)), []
+    if isinstance(boxes, dict):
+        boxes = [boxes]
+    coords, labels, _ = boxes_to_array(boxes)
+    # 切片输入尺寸下的坐标 -> 切片像素坐标 -> 原图坐标
+    scaled = coords / np.array([input_width, input_height] * 2) * np.array([tile_width, tile_height] * 2)
+    return scaled + np.array([left, top] * 2), labels
+
+def inference_tiled(image_path, prompt, sys_prompt="您是一位助手。", model_id="qwen2.5-vl-72b-instruct",
+                    min_pixels=512*28*28, max_pixels=2048*28*28, tile_size=None, overlap=0.2,
+                    iou_threshold=0.5, max_workers=8, client=None):
+    """切片检测大图：每个切片按模型原生分辨率发送，结果换算回原图坐标并用 NMS 合并重叠区的重复框
+
+    tile_size 默认取不超过 max_pixels 的最大正方形（28 的倍数），切片基本不需要缩小，小目标不会因整图缩放而丢失。
+    切片并发请求（最多 max_workers 个），总耗时约为单次调用，单次请求的成本与整图模式相同。
+    返回原图像素坐标下的边界框列表 [{"bbox_2d": [x1, y1, x2, y2], "label": ...}]，
+    绘制时 plot_bounding_boxes 的输入尺寸传原图尺寸即可。
+    """
+    with stage("preprocess"):
+        image = Image.open(image_path)
+        image.load()
+    if tile_size is None:
+        tile_size = int(math.sqrt(max_pixels)) // 28 * 28
+    tiles = tile_grid(image.width, image.height, tile_size, overlap)
+
+    digest = None
+    if result_cache.enabled:
+        with stage("hash"):
+            digest = hash_image(image_path)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tiles))) as executor:
+        results = list(executor.map(
+            lambda tile: _infer_tile(image, tile, digest, prompt, sys_prompt, model_id, min_pixels, max_pixels, client),
+            tiles,
+        ))
+
+    coords = np.concatenate([tile_coords for tile_coords, _ in results]).reshape(-1, 4)
+    labels = [label for _, tile_labels in results for label in tile_labels]
+    tile_index = np.repeat(np.arange(len(tiles)), [len(tile_labels) for _, tile_labels in results])
+    # 原图尺寸下只做取整、排序和无效框过滤
+    scaled, valid = scale_boxes(coords, image.width, image.height, image.width, image.height)
+    kept = np.flatnonzero(valid)
+    candidates = scaled[kept].astype(np.float64)
+    partial = truncation_candidates(candidates, tile_index[kept], tiles, image.width, image.height)
+    kept = kept[nms(candidates, iou_threshold, partial=partial)]
+    kept.sort()
+    boxes = []
+    for i in kept.tolist():
+        box = {"bbox_2d": scaled[i].tolist()}
+        if labels[i] is not None:
+            box["label"] = labels[i]
+        boxes.append(box)
+    return boxes
+
 # 使用示例
 if __name__ == "__main__":
     # 图片路径和参数设置
@@ -141,10 +541,11 @@ if __name__ == "__main__":
     min_pixels = 512*28*28
     max_pixels = 2048*28*28
     
-    # 加载图片并调整大小
+    # 加载图片，按预算确定模型输入尺寸（预算不足时 max_pixels 会被调低，坐标按实际输入尺寸换算）
     image = Image.open(image_path)
     width, height = image.size
-    input_height, input_width = smart_resize(height, width, min_pixels, max_pixels)
+    plan = plan_request(width, height, min_pixels, max_pixels)
+    input_height, input_width = plan.height, plan.width
     
     # 设置提示词，强调需要识别每个独立的船
     prompt = """请详细分析图片中的每一个船，识别它们的具体位置。要求：
@@ -153,12 +554,19 @@ if __name__ == "__main__":
 3. 确保识别所有船，不要遗漏
 4. 返回格式示例：[{"bbox_2d":[x1,y1,x2,y2],"label":"船1"},...]"""
     
-    # 进行推理
-    response = inference_with_api(image_path, prompt, min_pixels=min_pixels, max_pixels=max_pixels)
-    
-    # 绘制结果
-    result_image = plot_bounding_boxes(image, response, input_width, input_height)
+    # 流式推理：每解析出一个完整的边界框就立即绘制，不必等待全部输出
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    chunks = inference_with_api_stream(image_path, prompt, min_pixels=min_pixels, max_pixels=max_pixels, plan=plan)
+    count = 0
+    for box in iter_bounding_boxes(chunks):
+        try:
+            if draw_bounding_box(draw, box, COLORS[count % len(COLORS)], input_width, input_height, width, height, font):
+                count += 1
+                print(f"第 {count} 个边界框：{box}")
+        except Exception as e:
+            print(f"处理边界框时出错：{e}")
     
     # 保存结果
-    result_image.save("result-boat.png")
-    print("处理完成，结果已保存为 result-boat.png")
\ No newline at end of file
+    image.save("result-boat.png")
+    print(f"处理完成，共 {count} 个边界框，结果已保存为 result-boat.png")
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""asgi_app 的请求指标：流式响应发送完之后才记录完成，耗时包含整个流"""
+import asyncio
+import io
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import FakeOpenAIServer  # noqa: E402
+
+pytest.importorskip('quart')
+
+
+@pytest.fixture(scope='module')
+def upstream():
+    # 约 1 秒的流：20 个 token，每秒 20 个
+    server = FakeOpenAIServer(latency=0.05, token_rate=20.0, output_tokens=20)
+    server.start()
+    os.environ['MODELSCOPE_BASE_URL'] = server.base_url
+    os.environ['RESULT_CACHE_MAX_BYTES'] = '0'
+    yield server
+    server.stop()
+
+
+def multipart(fields, files):
+    boundary = 'qwen-test-boundary'
+    body = b''
+    for name, value in fields.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+    for name, (filename, data) in files.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: image/png\r\n\r\n').encode() + data + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def png():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def sample(metric, name, **labels):
+    for sample_name, sample_labels, value in metric.samples():
+        if sample_name == name and all(dict(sample_labels).get(k) == v for k, v in labels.items()):
+            return value
+    return 0
+
+
+def test_streamed_upload_is_timed_to_the_end_of_the_body(upstream):
+    import asgi_app
+    from metrics import HTTP_LATENCY, HTTP_REQUESTS, IN_FLIGHT
+
+    body, content_type = multipart({'prompt': 'x', 'stream': '1'}, {'file': ('a.png', png())})
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST', 'scheme': 'http',
+        'path': '/upload', 'raw_path': b'/upload', 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'test'), (b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 1234), 'server': ('test', 80), 'extensions': {},
+    }
+    requests_before = sample(HTTP_REQUESTS, 'qwen_http_requests_total', endpoint='/upload', status='200')
+    duration_before = sample(HTTP_LATENCY, 'qwen_http_request_duration_seconds_sum', endpoint='/upload')
+    in_flight_during = []
+    chunks = []
+
+    async def run():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                chunks.append(message['body'])
+                in_flight_during.append(sample(IN_FLIGHT, 'qwen_http_requests_in_flight'))
+
+        await asgi_app.app(scope, receive, send)
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - started
+
+    assert elapsed > 0.8
+    assert b'event: done' in b''.join(chunks)
+    assert in_flight_during and all(value >= 1 for value in in_flight_during)
+    assert sample(IN_FLIGHT, 'qwen_http_requests_in_flight') == 0
+    assert sample(HTTP_REQUESTS, 'qwen_http_requests_total', endpoint='/upload', status='200') == requests_before + 1
+    duration = sample(HTTP_LATENCY, 'qwen_http_request_duration_seconds_sum', endpoint='/upload') - duration_before
+    assert duration >= 0.8 * elapsed
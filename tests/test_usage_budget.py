@@ -0,0 +1,65 @@
+"""调用方预算：准入时预留估算的 token，并发请求不会一起超出预算；record 结算、release 退还"""
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from usage import BudgetConfig, BudgetExceeded, UsageTracker  # noqa: E402
+
+
+def resize(height, width, min_pixels, max_pixels):
+    # 固定 10×28×28 像素，每次估算 100 个图片 token
+    return 280, 280
+
+
+def tracker(tmp_path=None):
+    usage = UsageTracker(BudgetConfig(request_image_tokens=0, client_tokens=1000, client_window=3600), pricing={})
+    if tmp_path is not None:
+        usage.share_windows(str(tmp_path / 'windows.sqlite3'))
+    return usage
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_concurrent_plans_do_not_overshoot(tmp_path, shared):
+    usage = tracker(tmp_path if shared else None)
+    admitted = []
+    rejected = []
+    barrier = threading.Barrier(30)
+
+    def admit():
+        barrier.wait()
+        try:
+            admitted.append(usage.plan('describe', 280, 280, 1, 10 ** 6, resize, 'c'))
+        except BudgetExceeded:
+            rejected.append(1)
+
+    threads = [threading.Thread(target=admit) for _ in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 10
+    assert len(rejected) == 20
+    assert usage.client_used('c') == 1000
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_record_settles_and_release_returns(tmp_path, shared):
+    usage = tracker(tmp_path if shared else None)
+    plan = usage.plan('describe', 280, 280, 1, 10 ** 6, resize, 'c')
+    assert usage.client_used('c') == 100
+    usage.record('describe', 'm', SimpleNamespace(prompt_tokens=150, completion_tokens=30), 0.1, plan, 'c')
+    assert usage.client_used('c') == 180
+    # 已结算的 plan 再 release 不受影响
+    usage.release(plan)
+    assert usage.client_used('c') == 180
+
+    failed = usage.plan('describe', 280, 280, 1, 10 ** 6, resize, 'c')
+    assert usage.client_used('c') == 280
+    usage.release(failed)
+    usage.release(failed)
+    assert usage.client_used('c') == 180
@@ -0,0 +1,427 @@
+"""用量统计与预算：记录每次模型调用的 token、费用和耗时，按预算调低 max_pixels 或拒绝请求
+
+图片 token 在发送前按 smart_resize 的结果估算（每 28×28 像素一个 token）。超过预算时先调低 max_pixels，
+图片缩得更小、token 更少；调到 min_pixels 仍不够时抛出 BudgetExceeded。准入时在调用方窗口中预留估算的
+图片 token，并发请求不会一起超出预算；调用完成后 record 把预留改为上游返回的 usage（没有时按估算值），
+调用失败或命中缓存时由 release 退还。
+
+    QWEN_REQUEST_IMAGE_TOKENS   单次请求的图片 token 上限，0 为不限
+    QWEN_CLIENT_TOKEN_BUDGET    每个调用方在 QWEN_CLIENT_BUDGET_WINDOW 秒（默认 3600）内的 token 上限，0 为不限
+    QWEN_PRICING                每千 token 单价，JSON 字符串或文件路径：{"模型": {"input": 0.016, "output": 0.048}}
+    QWEN_USAGE_MAX_ROWS         汇总行数上限（默认 10000），超出时最久未更新的行并入调用方为 "(other)" 的行
+
+统计按 (入口, 模型, 调用方, max_pixels) 汇总，由 /usage 导出，用于容量规划；token 和费用同时计入 /metrics。
+调用方窗口内没有用量时即被删除，汇总行数有上限，调用方数量再多内存也不会无限增长。
+
+调用方窗口默认保存在进程内存中；serve.py 多进程部署时调用 share_windows，改为保存在各 worker 共用的
+SQLite 文件中，预算按所有 worker 的合计计算。汇总行仍按进程统计，由 merge_snapshots 合并。
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+
+from metrics import Counter
+
+IMAGE_TOKEN_PIXELS = 28 * 28
+RESERVE_ATTEMPTS = 3  # 预留时余量被并发请求占用，重新计算的次数
+OTHER_CLIENTS = '(other)'
+
+USAGE_TOKENS = Counter('qwen_usage_tokens_total', 'Tokens by entry point, model and kind',
+                       ('entry', 'model', 'kind'))
+USAGE_COST = Counter('qwen_usage_cost_total', 'Estimated spend from QWEN_PRICING', ('entry', 'model'))
+BUDGET_ACTIONS = Counter('qwen_budget_actions_total', 'Requests downgraded or rejected by usage budgets',
+                         ('entry', 'action'))
+
+
+class BudgetExceeded(Exception):
+    """预算不足：max_pixels 调到 min_pixels 仍超出，或调用方在窗口内的用量已满"""
+
+
+def estimate_image_tokens(width, height):
+    """模型输入尺寸下的图片 token 数"""
+    return math.ceil(width * height / IMAGE_TOKEN_PIXELS)
+
+
+def load_pricing():
+    """读取 QWEN_PRICING（JSON 字符串或文件路径），返回 {模型: {"input": 单价, "output": 单价}}"""
+    value = os.getenv('QWEN_PRICING', '').strip()
+    if not value:
+        return {}
+    if not value.startswith('{'):
+        with open(value, encoding='utf-8') as f:
+            value = f.read()
+    return json.loads(value)
+
+
+@dataclass
+class BudgetConfig:
+    """用量预算配置"""
+    request_image_tokens: int = field(default_factory=lambda: int(os.getenv('QWEN_REQUEST_IMAGE_TOKENS', '0')))
+    client_tokens: int = field(default_factory=lambda: int(os.getenv('QWEN_CLIENT_TOKEN_BUDGET', '0')))
+    client_window: float = field(default_factory=lambda: float(os.getenv('QWEN_CLIENT_BUDGET_WINDOW', '3600')))
+
+
+@dataclass
+class Plan:
+    """按预算确定的本次请求的图片参数；width/height 为模型输入尺寸"""
+    max_pixels: int
+    width: int
+    height: int
+    image_tokens: int
+    downgraded: bool = False
+    reservation: object = field(default=None, repr=False, compare=False)  # 调用方窗口中的预留，record/release 后清空
+
+
+class LocalWindows:
+    """进程内的调用方滑动窗口：调用方 -> deque[[时间, token]]；预留的句柄就是窗口中的条目"""
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._last_sweep = time.monotonic()
+
+    def _used(self, client, now):
+        window = self._windows.get(client)
+        if not window:
+            return 0
+        cutoff = now - self.window
+        while window and window[0][0] < cutoff:
+            window.popleft()
+        if not window:
+            # 窗口已空的调用方不再占用内存
+            del self._windows[client]
+            return 0
+        return sum(tokens for _, tokens in window)
+
+    def used(self, client):
+        with self._lock:
+            return self._used(client, time.monotonic())
+
+    def reserve(self, client, tokens, budget):
+        """窗口内用量加 tokens 不超过 budget 时预留并返回句柄，否则返回 None；检查和预留在同一把锁内"""
+        with self._lock:
+            now = time.monotonic()
+            if self._used(client, now) + tokens > budget:
+                return None
+            entry = [now, tokens]
+            self._windows.setdefault(client, deque()).append(entry)
+            return entry
+
+    def settle(self, reservation, tokens):
+        """把预留改为实际用量"""
+        with self._lock:
+            reservation[1] = tokens
+
+    def release(self, reservation):
+        self.settle(reservation, 0)
+
+    def add(self, client, tokens):
+        now = time.monotonic()
+        with self._lock:
+            self._windows.setdefault(client, deque()).append([now, tokens])
+            # 定期清理不再出现的调用方；间隔不超过窗口长度，过期的调用方最多多留一个窗口
+            if now - self._last_sweep >= min(60.0, self.window):
+                self._last_sweep = now
+                for other in list(self._windows):
+                    self._used(other, now)
+
+    def clients(self):
+        now = time.monotonic()
+        with self._lock:
+            used = {client: self._used(client, now) for client in list(self._windows)}
+        return {client: tokens for client, tokens in used.items() if tokens}
+
+
+class SharedWindows:
+    """保存在 SQLite 中的调用方滑动窗口，多个 worker 进程共用同一个数据库文件
+
+    时间用 time.time()，进程重启后窗口仍然有效。预留是一行记录，句柄为行号。
+    """
+
+    def __init__(self, window, db_path):
+        self.window = window
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # 与结果缓存相同：WAL 允许读写并发，写冲突时最多等待 10 秒
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS usage_windows ('
+            'id INTEGER PRIMARY KEY, client TEXT NOT NULL, at REAL NOT NULL, tokens INTEGER NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS usage_windows_client ON usage_windows (client, at)')
+        self._db.commit()
+        self._last_sweep = 0.0
+
+    def used(self, client):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT COALESCE(SUM(tokens), 0) FROM usage_windows WHERE client = ? AND at >= ?',
+                (client, time.time() - self.window),
+            ).fetchone()
+        return row[0]
+
+    def reserve(self, client, tokens, budget):
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE 先取得写锁，其他 worker 的预留要等本次检查和插入完成
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                used, = self._db.execute(
+                    'SELECT COALESCE(SUM(tokens), 0) FROM usage_windows WHERE client = ? AND at >= ?',
+                    (client, now - self.window),
+                ).fetchone()
+                if used + tokens > budget:
+                    return None
+                return self._db.execute(
+                    'INSERT INTO usage_windows (client, at, tokens) VALUES (?, ?, ?)', (client, now, tokens),
+                ).lastrowid
+            finally:
+                self._db.commit()
+
+    def settle(self, reservation, tokens):
+        with self._lock:
+            self._db.execute('UPDATE usage_windows SET tokens = ? WHERE id = ?', (tokens, reservation))
+            self._db.commit()
+
+    def release(self, reservation):
+        with self._lock:
+            self._db.execute('DELETE FROM usage_windows WHERE id = ?', (reservation,))
+            self._db.commit()
+
+    def add(self, client, tokens):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT INTO usage_windows (client, at, tokens) VALUES (?, ?, ?)', (client, now, tokens))
+            if now - self._last_sweep >= min(60.0, self.window):
+                self._last_sweep = now
+                self._db.execute('DELETE FROM usage_windows WHERE at < ?', (now - self.window,))
+            self._db.commit()
+
+    def clients(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT client, SUM(tokens) FROM usage_windows WHERE at >= ? GROUP BY client',
+                (time.time() - self.window,),
+            ).fetchall()
+        return {client: used for client, used in rows if used}
+
+
+class UsageTracker:
+    """线程安全的用量汇总和调用方滑动窗口"""
+
+    def __init__(self, config=None, pricing=None, max_rows=None):
+        self.config = config or BudgetConfig()
+        self.pricing = load_pricing() if pricing is None else pricing
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv('QWEN_USAGE_MAX_ROWS', '10000'))
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()  # (入口, 模型, 调用方, max_pixels) -> 累计值，按最近更新排序
+        self._rejections = OrderedDict()  # (入口, 调用方) -> 次数
+        self._windows = LocalWindows(self.config.client_window)
+
+    def share_windows(self, db_path):
+        """fork 出的 worker 中调用：调用方窗口改存到各 worker 共用的 SQLite 文件，预算按合计计算"""
+        self._windows = SharedWindows(self.config.client_window, db_path)
+
+    def _fold_oldest(self, table, key_other, merge):
+        # 超出行数上限时，最久未更新的行并入对应的 "(other)" 行，总量不变
+        for _ in range(len(table)):
+            if self.max_rows <= 0 or len(table) <= self.max_rows:
+                return
+            key, values = table.popitem(last=False)
+            other = key_other(key)
+            if other == key:
+                # 本身就是 "(other)" 行，放回末尾
+                table[key] = values
+            else:
+                table[other] = merge(table[other], values) if other in table else values
+
+    def client_used(self, client):
+        """调用方在预算窗口内已用的 token"""
+        return self._windows.used(client)
+
+    def client_usage(self):
+        """窗口内有用量的调用方 {调用方: token}"""
+        return self._windows.clients()
+
+    def _reject(self, entry, client, message):
+        BUDGET_ACTIONS.inc(entry=entry, action='rejected')
+        with self._lock:
+            key = (entry, client or '-')
+            self._rejections[key] = self._rejections.pop(key, 0) + 1
+            self._fold_oldest(self._rejections, lambda key: (key[0], OTHER_CLIENTS), int.__add__)
+        raise BudgetExceeded(message)
+
+    def plan(self, entry, width, height, min_pixels, max_pixels, resize, client=None):
+        """按预算确定本次请求的 max_pixels 和模型输入尺寸，并在调用方窗口中预留估算的图片 token
+
+        width/height 为原图尺寸，resize 为该入口使用的 smart_resize（按关键字传入 min_pixels/max_pixels，
+        返回 (height, width)）。不超预算时原样使用 max_pixels；超出时调低，仍不够则抛出 BudgetExceeded。
+        返回的 plan 必须交给 record（调用完成）或 release（失败、命中缓存），否则预留要到窗口过期才释放。
+        """
+        if client is None or self.config.client_tokens <= 0:
+            return self._admit(entry, self._fit(entry, width, height, min_pixels, max_pixels, resize, client, None))
+        budget = self.config.client_tokens
+        for _ in range(RESERVE_ATTEMPTS):
+            remaining = budget - self.client_used(client)
+            if remaining <= 0:
+                break
+            plan = self._fit(entry, width, height, min_pixels, max_pixels, resize, client, remaining)
+            plan.reservation = self._windows.reserve(client, plan.image_tokens, budget)
+            if plan.reservation is not None:
+                return self._admit(entry, plan)
+            # 计算期间其他请求占用了预算，按新的余量重新计算
+        self._reject(entry, client, f'client {client!r} has used its {budget} token budget '
+                                    f'for the last {self.config.client_window:g}s')
+
+    @staticmethod
+    def _admit(entry, plan):
+        if plan.downgraded:
+            BUDGET_ACTIONS.inc(entry=entry, action='downgraded')
+        return plan
+
+    def _fit(self, entry, width, height, min_pixels, max_pixels, resize, client, remaining):
+        # remaining 为调用方预算余量，None 为不限
+        limit = self.config.request_image_tokens if self.config.request_image_tokens > 0 else None
+        if remaining is not None:
+            limit = remaining if limit is None else min(limit, remaining)
+
+        height_out, width_out = resize(height, width, min_pixels=min_pixels, max_pixels=max_pixels)
+        tokens = estimate_image_tokens(width_out, height_out)
+        if limit is None or tokens <= limit:
+            return Plan(max_pixels, width_out, height_out, tokens)
+
+        # 按 token 上限换算像素上限；smart_resize 按 28 取整后可能略超，逐步收紧
+        budget_pixels = min(max_pixels, limit * IMAGE_TOKEN_PIXELS)
+        while budget_pixels >= min_pixels:
+            height_out, width_out = resize(height, width, min_pixels=min_pixels, max_pixels=budget_pixels)
+            tokens = estimate_image_tokens(width_out, height_out)
+            if tokens <= limit:
+                return Plan(budget_pixels, width_out, height_out, tokens, downgraded=True)
+            budget_pixels = int(budget_pixels * 0.9)
+        height_out, width_out = resize(height, width, min_pixels=min_pixels, max_pixels=min_pixels)
+        self._reject(entry, client, f'image needs at least {estimate_image_tokens(width_out, height_out)} tokens '
+                                    f'at min_pixels, budget allows {limit}')
+
+    def release(self, plan):
+        """退还 plan 预留的 token；调用失败或命中缓存时调用，已经 record 过的 plan 不受影响"""
+        if plan is not None and plan.reservation is not None:
+            reservation, plan.reservation = plan.reservation, None
+            self._windows.release(reservation)
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        price = self.pricing.get(model)
+        if not price:
+            return 0.0
+        return (prompt_tokens * price.get('input', 0) + completion_tokens * price.get('output', 0)) / 1000
+
+    def record(self, entry, model, usage, wall_time, plan=None, client=None):
+        """记录一次上游调用；usage 为响应的 usage 对象（流式且上游未返回时为 None）"""
+        prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        completion_tokens = getattr(usage, 'completion_tokens', None)
+        image_tokens = plan.image_tokens if plan is not None else 0
+        # 上游没有返回 usage 时，输入按估算的图片 token 计
+        prompt = prompt_tokens if prompt_tokens is not None else image_tokens
+        completion = completion_tokens or 0
+        cost = self.cost(model, prompt, completion)
+
+        key = (entry, model, client or '-', plan.max_pixels if plan is not None else None)
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                row = {
+                    'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'image_tokens_estimated': 0,
+                    'wall_time': 0.0, 'cost': 0.0, 'usage_missing': 0, 'downgraded': 0,
+                }
+            self._rows[key] = row
+            row['requests'] += 1
+            row['prompt_tokens'] += prompt
+            row['completion_tokens'] += completion
+            row['image_tokens_estimated'] += image_tokens
+            row['wall_time'] += wall_time
+            row['cost'] += cost
+            row['usage_missing'] += usage is None
+            row['downgraded'] += bool(plan is not None and plan.downgraded)
+            self._fold_oldest(self._rows, lambda key: (key[0], key[1], OTHER_CLIENTS, key[3]), self._merge_rows)
+        if plan is not None and plan.reservation is not None:
+            # 预留改为实际用量
+            reservation, plan.reservation = plan.reservation, None
+            self._windows.settle(reservation, prompt + completion)
+        elif client is not None:
+            self._windows.add(client, prompt + completion)
+
+        USAGE_TOKENS.inc(prompt, entry=entry, model=model, kind='prompt')
+        USAGE_TOKENS.inc(completion, entry=entry, model=model, kind='completion')
+        USAGE_TOKENS.inc(image_tokens, entry=entry, model=model, kind='image_estimated')
+        if cost:
+            USAGE_COST.inc(cost, entry=entry, model=model)
+
+    @staticmethod
+    def _merge_rows(into, values):
+        for name, value in values.items():
+            into[name] += value
+        return into
+
+    def snapshot(self):
+        """按 (入口, 模型, 调用方, max_pixels) 汇总的用量、总计、各调用方窗口用量和拒绝次数"""
+        with self._lock:
+            rows = [dict(entry=entry, model=model, client=client, max_pixels=max_pixels, **values)
+                    for (entry, model, client, max_pixels), values in self._rows.items()]
+            rejections = [{'entry': entry, 'client': client, 'rejected': count}
+                          for (entry, client), count in self._rejections.items()]
+        return _summarize(rows, rejections, self.client_usage(), self.config)
+
+
+ROW_FIELDS = ('requests', 'prompt_tokens', 'completion_tokens', 'image_tokens_estimated',
+              'wall_time', 'cost', 'usage_missing', 'downgraded')
+
+
+def _summarize(rows, rejections, clients, config):
+    totals = {}
+    for row in rows:
+        row['avg_wall_time'] = row['wall_time'] / row['requests']
+        for name in ROW_FIELDS:
+            totals[name] = totals.get(name, 0) + row[name]
+    totals['rejected'] = sum(item['rejected'] for item in rejections)
+    return {
+        'totals': totals,
+        'rows': rows,
+        'clients': {client: {'used': used, 'budget': config.client_tokens or None}
+                    for client, used in clients.items()},
+        'rejections': rejections,
+        'budgets': asdict(config),
+    }
+
+
+def merge_snapshots(snapshots, config=None, clients=None):
+    """合并多个 worker 的 snapshot()：汇总行和拒绝次数相加
+
+    clients 为调用方窗口用量 {调用方: token}；窗口共享时传入当前值，不传时取各快照中的最大值。
+    """
+    rows = {}
+    rejections = {}
+    latest = {}
+    for snapshot in snapshots:
+        for row in snapshot['rows']:
+            key = (row['entry'], row['model'], row['client'], row['max_pixels'])
+            merged = rows.setdefault(key, dict(row, **{name: 0 for name in ROW_FIELDS}))
+            for name in ROW_FIELDS:
+                merged[name] += row[name]
+        for item in snapshot['rejections']:
+            key = (item['entry'], item['client'])
+            rejections[key] = rejections.get(key, 0) + item['rejected']
+        for client, item in snapshot['clients'].items():
+            latest[client] = max(latest.get(client, 0), item['used'])
+    rejections = [{'entry': entry, 'client': client, 'rejected': count}
+                  for (entry, client), count in rejections.items()]
+    return _summarize(list(rows.values()), rejections, latest if clients is None else clients,
+                      config or BudgetConfig())
+
+
+usage_tracker = UsageTracker()